@@ -3,8 +3,14 @@ from rdflib import Graph, URIRef
 from sys import argv
 
 from config import Config
+from kgmetrics.catalog_store import CatalogStore, is_catalog_store
+from kgmetrics.overlay_graph import OverlayGraph
 
 def loadKG(filename):
+    if is_catalog_store(filename):
+        print(f'Opening {filename} as a compiled catalog store ...')
+        return CatalogStore(filename)
+
     print(f'Loading {filename} as an RDFLib graph ...')
 
     graph = Graph()
@@ -12,16 +18,42 @@ def loadKG(filename):
 
     return graph
 
+class ExtraMetadataIndex:
+    """
+    The catalog's extra-metadata triples, indexed by subject, collected once per catalog.
+
+    Expanding a neighborhood then only looks up its own terms, instead of copying every
+    extra-metadata triple of the catalog for each recommendable. Predicates are IRIs, as plain
+    strings (as in the config) or URIRefs.
+    """
+
+    def __init__(self, catalog, extraMetadata):
+        print('Indexing catalog extra metadata ...')
+
+        self.__bySubject = dict()
+        for extra in map(URIRef, extraMetadata):
+            for triple in catalog.triples((None, extra, None)):
+                self.__bySubject.setdefault(triple[0], []).append(triple)
+
+    def __len__(self):
+        return sum(len(triples) for triples in self.__bySubject.values())
+
+    def triplesAbout(self, term):
+        return self.__bySubject.get(term, ())
+
 def addExtraMetadata(kg, catalog, extraMetadata):
-    extraTriples = Graph()
-    for extra in extraMetadata:
-        extraTriples += catalog.triples((None, extra, None))
+    # Extra metadata of every term (subject, predicate or object) of the KG's own triples; added
+    # triples aren't expanded again
+    if not isinstance(extraMetadata, ExtraMetadataIndex):
+        extraMetadata = ExtraMetadataIndex(catalog, extraMetadata)
+
+    terms = dict()
+    for triple in kg:
+        terms.update(dict.fromkeys(triple))
 
-    for s, p, o in kg.triples((None, None, None)):
-         kg += extraTriples.triples((s, None, None))
-         kg += extraTriples.triples((p, None, None))
-         kg += extraTriples.triples((o, None, None))
-            
+    for t in terms:
+        for triple in extraMetadata.triplesAbout(t):
+            kg.add(triple)
 
 def getNeighbors(catalog, recommendable, extraMetadata):
     print(f'Gathering {recommendable} neighbors ...')
@@ -37,11 +69,10 @@ def getNeighbors(catalog, recommendable, extraMetadata):
 def addNeighbors(catalogKG, userProfileKG, recommendable, extraMetadata, saveFile=False):
     neighborsKG = getNeighbors(catalogKG, recommendable, extraMetadata)
     
-    resultKG = Graph()
-    resultKG = userProfileKG + neighborsKG
+    resultKG = OverlayGraph(userProfileKG, neighborsKG)
 
     if saveFile:
-        resultKG.serialize(format="ttl", destination="neighbors.ttl")
+        resultKG.serialize(destination="neighbors.ttl")
 
     return resultKG
 
@@ -0,0 +1,75 @@
+import time
+
+import numpy as np
+
+from argparse import ArgumentParser
+from rdflib import URIRef
+from scipy.stats import kendalltau
+from sys import argv
+
+from add_neighbors import ExtraMetadataIndex, getNeighbors
+from config import Config
+from get_recommendables import RecommendableIndex, loadCatalog, loadKG
+from kgmetrics.metrics import IncrementalMetrics, approximate_concentration, compute_nx_metric
+from recommend import getApplicableNodes
+
+def getCandidates(catalogKG, userProfileKG, limit):
+    cfg = Config()
+    recommendableType = URIRef(cfg.getRecommendableType())
+
+    nodes = getApplicableNodes(userProfileKG, cfg.getPredicateTypes())
+    candidates = RecommendableIndex(catalogKG, recommendableType).getCandidates(userProfileKG, nodes)
+
+    return sorted(candidates)[:limit]
+
+def main(args):
+    arg_p = ArgumentParser('python benchmark_approximation.py', description='Compares the candidate ranking of exact and pivot-sampled centralities (Kendall tau) for several numbers of pivots.')
+    arg_p.add_argument('-m', '--metric', type=str, default='betweenness', help='Metric to approximate (betweenness or closeness)')
+    arg_p.add_argument('-k', '--pivots', type=str, default='16,64,256,1024', help='Comma-separated numbers of pivots')
+    arg_p.add_argument('-s', '--seed', type=int, default=42, help='Seed for sampling the pivots')
+    arg_p.add_argument('-n', '--candidates', type=int, default=100, help='Maximum number of candidates to rank')
+    arg_p.add_argument('Catalog', metavar='catalog', type=str, default=None, help='catalog KG file (*.ttl) or compiled store')
+    arg_p.add_argument('Profile', metavar='profile', type=str, default=None, help='user-profile KG file (*.ttl)')
+
+    args = arg_p.parse_args(args[1:])
+
+    catalogKG = loadCatalog(args.Catalog)
+    userProfileKG = loadKG(args.Profile)
+    extraMetadata = ExtraMetadataIndex(catalogKG, Config().getExtraMetadataTypes())
+
+    candidates = getCandidates(catalogKG, userProfileKG, args.candidates)
+    pivots = [int(k) for k in args.pivots.split(',')]
+
+    profileMetrics = IncrementalMetrics(userProfileKG)
+
+    exact = []
+    approximate = {k: [] for k in pivots}
+    errors = {k: [] for k in pivots}
+    seconds = {k: 0.0 for k in [None] + pivots}
+
+    for r in candidates:
+        profileMetrics.apply_delta(getNeighbors(catalogKG, r, extraMetadata))
+        nx_kg = profileMetrics.graph
+
+        start = time.perf_counter()
+        exact.append(compute_nx_metric(nx_kg, args.metric))
+        seconds[None] += time.perf_counter() - start
+
+        for k in pivots:
+            start = time.perf_counter()
+            value, error = approximate_concentration(nx_kg, args.metric, k, args.seed)
+            seconds[k] += time.perf_counter() - start
+            approximate[k].append(value)
+            errors[k].append(error)
+
+        profileMetrics.rollback()
+
+    print(f'{len(candidates)} candidates, exact {args.metric}: {seconds[None]:.2f}s')
+    print('k\tkendall_tau\tmean_std_error\tseconds\tspeedup')
+    for k in pivots:
+        tau = kendalltau(exact, approximate[k]).statistic
+        speedup = seconds[None] / seconds[k] if seconds[k] > 0 else float('inf')
+        print(f'{k}\t{tau:.4f}\t{np.nanmean(errors[k]):.3g}\t{seconds[k]:.2f}\t{speedup:.1f}x')
+
+if __name__ == '__main__':
+    exit(main(argv))
@@ -0,0 +1,38 @@
+import logging
+
+from argparse import ArgumentParser
+from rdflib import Graph
+from sys import argv
+
+from kgmetrics.catalog_store import compile_catalog, save_catalog
+from kgmetrics.line_loader import parse_triples
+
+def main(args):
+    arg_p = ArgumentParser('python catalog_store.py', description='Compiles a catalog KG into an integer-encoded, memory-mapped store.')
+    arg_p.add_argument('-j', '--jobs', type=int, default=1, help='Number of processes parsing the catalog, if it\'s in the one-triple-per-line dialect of parseCSV.py (default: 1).')
+    arg_p.add_argument('Catalog', metavar='catalog', type=str, default=None, help='catalog KG file (*.ttl)')
+    arg_p.add_argument('Store', metavar='store', type=str, default=None, help='output directory for the compiled store')
+
+    args = arg_p.parse_args(args[1:])
+
+    catalog = args.Catalog
+    if catalog is None:
+        print('No catalog KG provided.')
+        exit(1)
+
+    # kgmetrics reports its progress through logging
+    logging.basicConfig(format='%(message)s ...', level=logging.INFO)
+
+    triples = parse_triples(catalog, args.jobs)
+    if triples is not None:
+        save_catalog(*triples, args.Store)
+    else:
+        print(f'Loading {catalog} as an RDFLib graph ...')
+        catalogKG = Graph()
+        catalogKG.parse(catalog, format="turtle")
+
+        compile_catalog(catalogKG, args.Store)
+    print(f'Stored it as {args.Store}')
+
+if __name__ == '__main__':
+    exit(main(argv))
@@ -1,55 +1,15 @@
-import networkx as nx
-import numpy as np
+import logging
 
 from argparse import ArgumentParser
-from concentrationMetrics import Index
-from rdflib.extras.external_graph_libs import rdflib_to_networkx_digraph
 from sys import argv
 
 from get_recommendables import loadKG
-
-def hhi(lst):
-    return Index().hhi(np.array(lst))
-
-def computeMetric(kg, metric):
-    print(f'Computing {metric} ...')
-
-    nx_kg = rdflib_to_networkx_digraph(kg)
-
-    if 'density' == metric:
-        return nx.density(nx_kg)
-    if 'numedges' == metric:
-        return nx_kg.number_of_edges()
-    if 'numnodes' == metric:
-        return nx_kg.number_of_nodes()
-    if 'avg_degree' == metric:
-        return nx_kg.number_of_edges() / nx_kg.number_of_nodes()
-
-    if 'betweenness' == metric:
-        computed = nx.betweenness_centrality(nx_kg)
-        return hhi(list(computed.values()))
-    if 'closeness' == metric:
-        computed = nx.closeness_centrality(nx_kg)
-        return hhi(list(computed.values()))
-    if 'pagerank' == metric:
-        computed = nx.pagerank(nx_kg)
-        return hhi(list(computed.values()))
-    if 'in_degree' == metric:
-        computed = nx.in_degree_centrality(nx_kg)
-        return hhi(list(computed.values()))
-    if 'out_degree' == metric:
-        computed = nx.out_degree_centrality(nx_kg)
-        return hhi(list(computed.values()))
-    if 'degree' == metric:
-        computed = nx.degree_centrality(nx_kg)
-        return hhi(list(computed.values()))
-
-    raise ValueError('Unsupported metric!')
+from kgmetrics.metrics import compute_metrics
 
 def main(args):
-    arg_p = ArgumentParser('python compute_metric.py', description='Computes a given metric in a KG.')
+    arg_p = ArgumentParser('python compute_metric.py', description='Computes the given metrics in a KG.')
     arg_p.add_argument('KnowledgeGraph', metavar='kg', type=str, default=None, help='KG file (*.ttl)')
-    arg_p.add_argument('-m', '--metric', type=str, default='numnodes', help='Metric for KG-based recommendation')
+    arg_p.add_argument('-m', '--metrics', type=str, default='numnodes', help='Comma-separated metric list (e.g. \'degree,pagerank,betweenness\').')
 
     args = arg_p.parse_args(args[1:])
     knowledgeGraph = args.KnowledgeGraph
@@ -58,11 +18,14 @@ def main(args):
         print('No KG provided.')
         exit(1)
 
+    # kgmetrics reports the standard errors of sampled metrics through logging
+    logging.basicConfig(format='%(message)s', level=logging.INFO)
+
     kg = loadKG(knowledgeGraph)
 
-    value = computeMetric(kg, args.metric)
-    print(value)
+    values = compute_metrics(kg, args.metrics.split(','))
+    for m, value in values.items():
+        print(f'{m}\t{value}')
 
 if __name__ == '__main__':
     exit(main(argv))
-
@@ -1,38 +1,147 @@
+import numpy as np
+
 from argparse import ArgumentParser
 from rdflib import Graph, URIRef
+from rdflib.term import Identifier
 from rdflib.namespace import RDF
 from sys import argv
 
 from config import Config
+from kgmetrics.catalog_store import CatalogStore, is_catalog_store
+from kgmetrics.line_loader import parse_triples
+from kgmetrics.terms import decode_term
+
+def loadKG(filename, jobs=1):
+    if is_catalog_store(filename):
+        print(f'Opening {filename} as a compiled catalog store ...')
+        return CatalogStore(filename)
 
-def loadKG(filename):
     print(f'Loading {filename} as an RDFLib graph ...')
 
     graph = Graph()
-    graph.parse(filename, format="turtle")
+
+    triples = parse_triples(filename, jobs)
+    if triples is None: # not in the one-triple-per-line dialect
+        graph.parse(filename, format="turtle")
+        return graph
+
+    keys, spo = triples
+    terms = [decode_term(k) for k in keys]
+    graph.addN((terms[s], terms[p], terms[o], graph) for s, p, o in spo.tolist())
 
     return graph
 
+def loadCatalog(filename, jobs=1):
+    """
+    A catalog KG as a read-only store, unless it's neither compiled nor in the one-triple-per-line
+    dialect; then it's parsed into an RDFLib graph.
+    """
+    if is_catalog_store(filename):
+        return loadKG(filename)
+
+    triples = parse_triples(filename, jobs)
+    if triples is None:
+        print(f'Loading {filename} as an RDFLib graph ...')
+        graph = Graph()
+        graph.parse(filename, format="turtle")
+        return graph
+
+    print(f'Loaded {filename} into an in-memory catalog store ...')
+    return CatalogStore.from_triples(*triples)
+
 def getPossibleRecommendables(catalog, profile, recommendableType):
     recommendables = catalog.subjects(predicate=RDF.type, object=recommendableType)
-    profile_recommendables = profile.subjects(predicate=RDF.type, object=recommendableType)
-
-    non_recommendables = [n for n in profile_recommendables]
+    non_recommendables = set(profile.subjects(predicate=RDF.type, object=recommendableType))
 
     return [r for r in recommendables if not r in non_recommendables]
 
 def getRecommendables(catalog, profile, start, recommendableType):
-    print(f'Getting recommendables for {start} ...')
+    return RecommendableIndex(catalog, recommendableType).getRecommendables(profile, start)
+
+class RecommendableIndex:
+    """
+    The recommendables of a catalog, collected once and shared by all profiles and starting nodes.
+
+    A profile's own recommendables are excluded through a set, or, on a compiled catalog store, a
+    bitmap over term IDs, so that neighbors are filtered without decoding them first.
+    `getCandidates` returns the candidates of all starting nodes of a profile in one pass.
+    """
+
+    def __init__(self, catalog, recommendableType):
+        print('Indexing catalog recommendables ...')
+
+        self.__catalog = catalog
+        self.__recommendableType = recommendableType
+
+        if isinstance(catalog, CatalogStore):
+            self.__recommendables = None
+            self.__bitmap = np.zeros(catalog.num_terms(), dtype=bool)
+            typeIds = [catalog.get_id(RDF.type), catalog.get_id(recommendableType)]
+            if None not in typeIds:
+                self.__bitmap[catalog.triple_ids(None, *typeIds)[:, 0]] = True
+        else:
+            self.__recommendables = frozenset(catalog.subjects(predicate=RDF.type, object=recommendableType))
+            self.__bitmap = None
+
+    def __len__(self):
+        if self.__bitmap is not None:
+            return int(np.count_nonzero(self.__bitmap))
+        return len(self.__recommendables)
+
+    def __contains__(self, r):
+        if self.__bitmap is not None:
+            rId = self.__catalog.get_id(r)
+            return rId is not None and bool(self.__bitmap[rId])
+        return r in self.__recommendables
+
+    def profileExclusion(self, profile):
+        excluded = profile.subjects(predicate=RDF.type, object=self.__recommendableType)
+
+        if self.__bitmap is None:
+            return set(excluded)
+
+        bitmap = self.__bitmap.copy()
+        ids = [self.__catalog.get_id(r) for r in excluded]
+        bitmap[[i for i in ids if i is not None]] = False
+        return bitmap
+
+    def getRecommendables(self, profile, start, exclusion=None):
+        print(f'Getting recommendables for {start} ...')
+
+        if exclusion is None:
+            exclusion = self.profileExclusion(profile)
+
+        if self.__bitmap is not None:
+            return self.__storeRecommendables(start, exclusion)
+
+        subjects = [s for s in self.__catalog.subjects(predicate=None, object=start) if s in self.__recommendables and s not in exclusion]
+        objects = [o for o in self.__catalog.objects(subject=start, predicate=None) if o in self.__recommendables and o not in exclusion]
+
+        # sorted, so that candidates come in the same order in every process
+        return sorted(set(subjects) | set(objects))
+
+    def __storeRecommendables(self, start, bitmap):
+        catalog = self.__catalog
+
+        startId = catalog.get_id(start) if isinstance(start, Identifier) else None
+        if startId is None:
+            return []
+
+        neighbors = np.concatenate([catalog.triple_ids(o=startId)[:, 0], catalog.triple_ids(s=startId)[:, 2]])
+        neighbors = np.unique(neighbors[bitmap[neighbors]])
 
-    recommendables = getPossibleRecommendables(catalog, profile, recommendableType)
+        return [catalog.get_term(i) for i in neighbors]
 
-    subjects = catalog.subjects(predicate=None, object=start)
-    subjects = [s for s in subjects if s in recommendables]
+    def getCandidates(self, profile, nodes):
+        """Deduplicated recommendables of all the given nodes, in the order they are first reached."""
+        exclusion = self.profileExclusion(profile)
 
-    objects = catalog.objects(subject=start, predicate=None)
-    objects = [o for o in objects if o in recommendables]
+        candidates = dict()
+        for n in nodes:
+            for r in self.getRecommendables(profile, n, exclusion):
+                candidates.setdefault(r)
 
-    return list(set(subjects) | set(objects))
+        return list(candidates)
 
 
 def main(args):
@@ -54,7 +163,7 @@ def main(args):
         print('No user-profile KG provided.')
         exit(1)
 
-    catalogKG = loadKG(catalog)
+    catalogKG = loadCatalog(catalog)
     userProfileKG = loadKG(profile)
 
     startingNode = URIRef(args.node)
@@ -1,3 +1,5 @@
+import logging
+import multiprocessing
 import os
 
 from argparse import ArgumentParser
@@ -5,10 +7,10 @@ from pathlib import Path
 from rdflib import URIRef
 from sys import argv
 
-from add_neighbors import addNeighbors
-from compute_metric import computeMetric
+from add_neighbors import ExtraMetadataIndex, getNeighbors
 from config import Config
-from get_recommendables import loadKG, getRecommendables
+from get_recommendables import RecommendableIndex, loadCatalog, loadKG
+from kgmetrics.metrics import IncrementalMetrics
 
 def getApplicableNodes(kg, predicateTypes):
     print('Getting all user-profile nodes ...')
@@ -20,12 +22,116 @@ def getApplicableNodes(kg, predicateTypes):
             subjects.add(s)
             objects.add(o)
 
-    return list(subjects.union(objects))
-         
+    return sorted(subjects.union(objects)) # sorted, for the same candidate order in every process
+
+def computeMetricsForRecommendable(profileMetrics, catalogKG, recommendable, extraMetadata, metrics):
+    neighborsKG = getNeighbors(catalogKG, recommendable, extraMetadata)
+
+    profileMetrics.apply_delta(neighborsKG)
+    try:
+        return profileMetrics.compute_metrics(metrics)
+    finally:
+        profileMetrics.rollback()
+
+def getProfileCandidates(profile, userProfileKG, recommendableIndex, predicateTypes, externalRecommendables):
+    if externalRecommendables is None: # find our own recommendables
+        nodes = getApplicableNodes(userProfileKG, predicateTypes)
+        return recommendableIndex.getCandidates(userProfileKG, nodes)
+
+    # use external recommendables
+    candidates = []
+    for r in externalRecommendables[Path(profile).stem]:
+        if (r, None, None) in userProfileKG or (None, None, r) in userProfileKG:
+            print(f'Skipping already-existing node {r}')
+            continue
+        candidates.append(r)
+
+    return candidates
+
+def writeRecommendations(profile, processed_recommendables, metrics):
+    for m in metrics:
+        # Sort: More relevant first
+        recos = dict(sorted(processed_recommendables.items(), key=lambda item: item[1][m], reverse=True))
+
+        # Save to file
+        profile_dir = os.path.dirname(profile)
+        profile_filename = Path(profile).stem # Remove path and extension
+        output_dir = os.path.join(profile_dir, 'recos')
+        output_dir = os.path.join(output_dir, f'{profile_filename}')
+        Path(output_dir).mkdir(parents=True, exist_ok=True) # Create if not exists
+
+        output_filename = os.path.join(output_dir, f'{m}.txt')
+        open(output_filename, 'w').close() # Clean if exists
+
+        with open(output_filename, 'a') as output_file:
+            for k, v in recos.items():
+                output_file.write(f'{k}\t{v[m]}\n')
+
+        print(f'Stored it as {output_filename}')
+
+# Set by the parent before forking, so that workers share the catalog copy-on-write instead of
+# unpickling it for every task
+workerCatalogKG = None
+workerExtraMetadata = None
+workerMetrics = None
+
+# (profile, IncrementalMetrics) of the profile a worker last evaluated, reused by its later chunks
+workerProfile = (None, None)
+
+def evaluateChunk(task):
+    global workerProfile
+
+    profileIndex, chunkIndex, profile, candidates = task
+
+    cachedProfile, profileMetrics = workerProfile
+    if cachedProfile != profile:
+        profileMetrics = IncrementalMetrics(loadKG(profile))
+        workerProfile = (profile, profileMetrics)
+
+    results = [(r, computeMetricsForRecommendable(profileMetrics, workerCatalogKG, r, workerExtraMetadata, workerMetrics)) for r in candidates]
+
+    return profileIndex, chunkIndex, results
+
+def splitChunks(candidates, chunkSize):
+    if chunkSize <= 0:
+        return [candidates]
+    return [candidates[i:i + chunkSize] for i in range(0, len(candidates), chunkSize)] or [[]]
+
+def recommendParallel(catalogKG, profiles, profileCandidates, extraMetadata, metrics, jobs, chunkSize):
+    """
+    Evaluates the candidates of all profiles in a pool of forked worker processes.
+
+    Each profile's candidates are split into chunks of chunkSize (all of them in one chunk if
+    chunkSize <= 0), and chunks are evaluated in any order. A profile's results are merged back in
+    candidate order once all its chunks are done, so the output is the same as in a serial run.
+    """
+    global workerCatalogKG, workerExtraMetadata, workerMetrics
+    workerCatalogKG, workerExtraMetadata, workerMetrics = catalogKG, extraMetadata, metrics
+
+    chunks = [splitChunks(candidates, chunkSize) for candidates in profileCandidates]
+    tasks = [(i, c, profile, chunk) for i, profile in enumerate(profiles) for c, chunk in enumerate(chunks[i])]
+
+    print(f'Evaluating {len(tasks)} chunks of {len(profiles)} profiles with {jobs} workers ...')
+
+    done = [dict() for _ in profiles]
+    with multiprocessing.get_context('fork').Pool(jobs) as pool:
+        for profileIndex, chunkIndex, results in pool.imap_unordered(evaluateChunk, tasks):
+            done[profileIndex][chunkIndex] = results
+            if len(done[profileIndex]) < len(chunks[profileIndex]):
+                continue
+
+            processed_recommendables = dict()
+            for c in range(len(chunks[profileIndex])):
+                processed_recommendables.update(done[profileIndex].pop(c))
+
+            writeRecommendations(profiles[profileIndex], processed_recommendables, metrics)
+
 def main(args):
     arg_p = ArgumentParser('python recommend.py', description='Gets recommendations for user-profile KGs, based on a catalog KG, and a given metric')
     arg_p.add_argument('-m', '--metrics', type=str, default=None, help='Comma-separated metric list (e.g. \'degree,eigenvector,betweenness\').')
     arg_p.add_argument('-r', '--recommendables', type=str, default=None, help='[OPTIONAL] File with a list of recommendable items. If not provided, we will build our own list, according to the catalog and the user-profile.')
+    arg_p.add_argument('-j', '--jobs', type=int, default=1, help='Number of worker processes (default: 1, no parallelism).')
+    arg_p.add_argument('-c', '--chunk-size', type=int, default=0, help='With --jobs, split each profile\'s candidates into chunks of this many, evaluated in parallel (default: 0, one chunk per profile).')
     arg_p.add_argument('Catalog', metavar='catalog', type=str, default=None, help='catalog KG file (*.ttl)')
     arg_p.add_argument('Profiles', metavar='profiles', type=str, default=[], nargs='+', help='Space-separated user-profile KG files (*.ttl)')
 
@@ -48,6 +154,9 @@ def main(args):
 
     metrics = metrics.split(',')
 
+    # kgmetrics reports the standard errors of sampled metrics through logging
+    logging.basicConfig(format='%(message)s', level=logging.INFO)
+
     recommendablesFile = args.recommendables
     externalRecommendables = None
     if recommendablesFile is None:
@@ -68,62 +177,25 @@ def main(args):
     cfg = Config()
     predicateTypes = cfg.getPredicateTypes()
     recommendableType = URIRef(cfg.getRecommendableType())
-    extraMetadata = cfg.getExtraMetadataTypes()
 
-    catalogKG = loadKG(catalog)
+    catalogKG = loadCatalog(catalog, args.jobs)
+    extraMetadata = ExtraMetadataIndex(catalogKG, cfg.getExtraMetadataTypes())
+    recommendableIndex = RecommendableIndex(catalogKG, recommendableType) if externalRecommendables is None else None
+
+    if args.jobs > 1:
+        profileCandidates = [getProfileCandidates(profile, loadKG(profile), recommendableIndex, predicateTypes, externalRecommendables) for profile in profiles]
+        recommendParallel(catalogKG, profiles, profileCandidates, extraMetadata, metrics, args.jobs, args.chunk_size)
+        return
 
     for profile in profiles:
         userProfileKG = loadKG(profile)
+        profileMetrics = IncrementalMetrics(userProfileKG)
 
         processed_recommendables = dict()
+        for r in getProfileCandidates(profile, userProfileKG, recommendableIndex, predicateTypes, externalRecommendables):
+            processed_recommendables[r] = computeMetricsForRecommendable(profileMetrics, catalogKG, r, extraMetadata, metrics)
 
-        if externalRecommendables is None: # find our own recommendables
-            nodes = getApplicableNodes(userProfileKG, predicateTypes)
-            for n in nodes:
-                recommendables = getRecommendables(catalogKG, userProfileKG, n, recommendableType)
-
-                for r in recommendables:
-                    if r in processed_recommendables:
-                        print(f'Skipping already-processed {r}')
-                        continue
-
-                    updatedUserProfileKG = addNeighbors(catalogKG, userProfileKG, r, extraMetadata)
-                    metrics_for_recommendable = dict()
-                    for m in metrics:
-                        metrics_for_recommendable[m] = computeMetric(updatedUserProfileKG, m)
-                    processed_recommendables[r] = metrics_for_recommendable
-
-        else: # use external recommendables
-            for r in externalRecommendables[Path(profile).stem]:
-                if (r, None, None) in userProfileKG or (None, None, r) in userProfileKG:
-                    print(f'Skipping already-existing node {r}')
-                    continue
-
-                updatedUserProfileKG = addNeighbors(catalogKG, userProfileKG, r, extraMetadata)
-                metrics_for_recommendable = dict()
-                for m in metrics:
-                    metrics_for_recommendable[m] = computeMetric(updatedUserProfileKG, m)
-                processed_recommendables[r] = metrics_for_recommendable
-
-        for m in metrics:
-            # Sort: More relevant first
-            recos = dict(sorted(processed_recommendables.items(), key=lambda item: item[1][m], reverse=True))
-
-            # Save to file
-            profile_dir = os.path.dirname(profile)
-            profile_filename = Path(profile).stem # Remove path and extension
-            output_dir = os.path.join(profile_dir, 'recos')
-            output_dir = os.path.join(output_dir, f'{profile_filename}')
-            Path(output_dir).mkdir(parents=True, exist_ok=True) # Create if not exists
-
-            output_filename = os.path.join(output_dir, f'{m}.txt')
-            open(output_filename, 'w').close() # Clean if exists
-
-            with open(output_filename, 'a') as output_file:
-                for k, v in recos.items():
-                    output_file.write(f'{k}\t{v[m]}\n')
-
-            print(f'Stored it as {output_filename}')
+        writeRecommendations(profile, processed_recommendables, metrics)
 
 if __name__ == '__main__':
     exit(main(argv))
@@ -0,0 +1,4 @@
+"""Code shared by kg-recos and lastfm-KG.
+
+Installed from the project root as part of requirements.txt (`pip install -e .`).
+"""
@@ -0,0 +1,187 @@
+import logging
+import os
+import pathlib
+from typing import Iterator
+
+import numpy as np
+import rdflib
+from rdflib.term import Identifier
+
+from kgmetrics.terms import decode_term, encode_term
+
+# Files of a compiled catalog. Terms are dictionary-encoded: ID i is the i-th term in
+# byte-order of its encoding, so a term's ID can be found by binary search over the
+# memory-mapped dictionary. Triples are stored twice as (T, 3) column-major ID arrays,
+# sorted by (s, p, o) and by (o, s, p).
+STORE_FILES = ["terms.npy", "term_offsets.npy", "spo.npy", "osp.npy"]
+
+
+def is_catalog_store(path: str | os.PathLike) -> bool:
+    path = pathlib.Path(path)
+    return path.is_dir() and all((path / f).is_file() for f in STORE_FILES)
+
+
+def encode_triples(kg: rdflib.Graph) -> tuple[list[bytes], np.ndarray]:
+    """The byte-sorted term keys of a graph, and its triples as an (n, 3) ID array."""
+    keys = sorted({encode_term(t) for triple in kg for t in triple})
+    ids = {k: i for i, k in enumerate(keys)}
+
+    id_type = np.int32 if len(keys) < np.iinfo(np.int32).max else np.int64
+    spo = np.array(
+        [ids[encode_term(t)] for triple in kg for t in triple], dtype=id_type
+    ).reshape(-1, 3)
+
+    return keys, spo
+
+
+def build_store(keys: list[bytes], spo: np.ndarray) -> tuple[np.ndarray, ...]:
+    """The arrays of STORE_FILES, in that order, for encoded triples.
+
+    Keys must be byte-sorted. Duplicate triples are stored once, as in a Graph.
+    """
+    offsets = np.zeros(len(keys) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(k) for k in keys])
+    terms = np.frombuffer(b"".join(keys), dtype=np.uint8)
+
+    spo = spo[np.lexsort((spo[:, 2], spo[:, 1], spo[:, 0]))]
+    spo = spo[np.concatenate(([True], (spo[1:] != spo[:-1]).any(axis=1)))[: len(spo)]]
+    osp = spo[np.lexsort((spo[:, 1], spo[:, 0], spo[:, 2]))][:, [2, 0, 1]]
+
+    return terms, offsets, np.asfortranarray(spo), np.asfortranarray(osp)
+
+
+def save_catalog(keys: list[bytes], spo: np.ndarray, store_dir: str | os.PathLike):
+    """Writes encoded triples: the byte-sorted term keys and an (n, 3) ID array."""
+    logger = logging.getLogger(__name__)
+    logger.info(f"Compiling {len(spo)} triples into {store_dir}")
+
+    store_dir = pathlib.Path(store_dir)
+    store_dir.mkdir(parents=True, exist_ok=True)
+    for name, array in zip(STORE_FILES, build_store(keys, spo)):
+        np.save(store_dir / name, array)
+
+
+def compile_catalog(kg: rdflib.Graph, store_dir: str | os.PathLike):
+    save_catalog(*encode_triples(kg), store_dir)
+
+
+class CatalogStore:
+    """Read-only, memory-mapped view of a compiled catalog KG.
+
+    Offers the part of the rdflib Graph API that neighborhood expansion and the
+    recommenders use (triples(), subjects(), objects(), subject_objects(), `in`,
+    iteration), so it can be passed wherever a catalog Graph is expected. Opening a
+    store only maps the files, so forked workers share the same pages in the OS page
+    cache instead of each holding a copy of the catalog.
+    """
+
+    def __init__(self, store_dir: str | os.PathLike):
+        store_dir = pathlib.Path(store_dir)
+
+        def load(name):  # plain ndarray views of the maps index faster than np.memmap
+            return np.load(store_dir / name, mmap_mode="r").view(np.ndarray)
+
+        self._terms = load("terms.npy")
+        self._offsets = load("term_offsets.npy")
+        self._spo = load("spo.npy")
+        self._osp = load("osp.npy")
+
+    @classmethod
+    def from_triples(cls, keys: list[bytes], spo: np.ndarray) -> "CatalogStore":
+        """An in-memory store of encoded triples, e.g. from encode_triples."""
+        store = cls.__new__(cls)
+        store._terms, store._offsets, store._spo, store._osp = build_store(keys, spo)
+        return store
+
+    def __len__(self) -> int:
+        return self._spo.shape[0]
+
+    def __iter__(self) -> Iterator[tuple]:
+        return self.triples((None, None, None))
+
+    def __contains__(self, triple: tuple) -> bool:
+        return next(self.triples(triple), None) is not None
+
+    def _key(self, term_id: int) -> bytes:
+        return self._terms[
+            self._offsets[term_id] : self._offsets[term_id + 1]
+        ].tobytes()
+
+    def num_terms(self) -> int:
+        return self._offsets.shape[0] - 1
+
+    def get_term(self, term_id: int) -> rdflib.term.Node:
+        return decode_term(self._key(term_id))
+
+    def get_id(self, term: rdflib.term.Node) -> int | None:
+        key = encode_term(term)
+
+        lo, hi = 0, self.num_terms()
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._key(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+
+        if lo < self.num_terms() and self._key(lo) == key:
+            return lo
+        return None
+
+    def triple_ids(self, s=None, p=None, o=None) -> np.ndarray:
+        """Matching triples as an (n, 3) array of (s, p, o) IDs; None is a wildcard."""
+        if s is not None:
+            lo, hi = np.searchsorted(self._spo[:, 0], [s, s + 1])
+            rows = self._spo[lo:hi]
+            if p is not None:
+                lo, hi = np.searchsorted(rows[:, 1], [p, p + 1])
+                rows = rows[lo:hi]
+            if o is not None:
+                rows = rows[rows[:, 2] == o]
+            return rows
+
+        if o is not None:
+            lo, hi = np.searchsorted(self._osp[:, 0], [o, o + 1])
+            rows = self._osp[lo:hi]
+            if p is not None:
+                rows = rows[rows[:, 2] == p]
+            return rows[:, [1, 2, 0]]
+
+        if p is not None:
+            return self._spo[np.flatnonzero(self._spo[:, 1] == p)]
+
+        return self._spo
+
+    def triples(self, triple: tuple) -> Iterator[tuple]:
+        ids = []
+        for term in triple:
+            if term is None:
+                ids.append(None)
+                continue
+
+            # as in rdflib, a plain str never equals a term
+            if not isinstance(term, Identifier):
+                return iter(())
+
+            term_id = self.get_id(term)
+            if term_id is None:  # unknown terms can't match anything
+                return iter(())
+            ids.append(term_id)
+
+        return self._decode_triples(self.triple_ids(*ids))
+
+    def _decode_triples(self, rows: np.ndarray) -> Iterator[tuple]:
+        for s, p, o in rows:
+            yield self.get_term(s), self.get_term(p), self.get_term(o)
+
+    def subjects(self, predicate=None, object=None, unique=False) -> Iterator:
+        subjects = (s for s, _, _ in self.triples((None, predicate, object)))
+        return iter(set(subjects)) if unique else subjects
+
+    def objects(self, subject=None, predicate=None, unique=False) -> Iterator:
+        objects = (o for _, _, o in self.triples((subject, predicate, None)))
+        return iter(set(objects)) if unique else objects
+
+    def subject_objects(self, predicate=None, unique=False) -> Iterator:
+        pairs = ((s, o) for s, _, o in self.triples((None, predicate, None)))
+        return iter(set(pairs)) if unique else pairs
@@ -0,0 +1,68 @@
+import numpy as np
+
+# Concentration indices over a vector of centrality scores. A metric picks one by
+# suffix, e.g. "pagerank:gini"; without a suffix, HHI is used.
+CONCENTRATION_INDICES = ["hhi", "gini", "theil", "entropy"]
+
+
+def split_concentration(metric: str) -> tuple[str, str]:
+    name, _, index = metric.partition(":")
+    index = index or "hhi"
+
+    if index not in CONCENTRATION_INDICES:
+        raise ValueError(f"Unsupported concentration index '{index}' in {metric}")
+
+    return name, index
+
+
+def get_weights(scores: np.ndarray) -> np.ndarray:
+    scores = np.asarray(scores, dtype=float)
+
+    if not (scores >= 0).all():
+        raise ValueError("Input data vector must have positive values")
+
+    total = scores.sum()
+    if not total > 0:
+        raise ValueError("Input data vector must have some non-zero values")
+
+    return scores / total
+
+
+def hhi_from_sums(n: int, total: float, squares: float) -> float:
+    # Normalized Herfindahl-Hirschman index, as concentrationMetrics.Index().hhi(),
+    # of a vector of n entries given the sum of the entries and of their squares
+    if not total > 0:
+        raise ValueError("Input data vector must have some non-zero values")
+
+    h = np.float64(squares) / np.float64(total) ** 2
+    return (h - 1.0 / n) / (1.0 - 1.0 / n)
+
+
+def concentration_indices(
+    scores: np.ndarray, indices: list[str] = CONCENTRATION_INDICES
+) -> dict[str, float]:
+    """The requested concentration indices of a score vector.
+
+    Definitions are the same as in concentrationMetrics.Index(). The vector is
+    normalized once and shared by all indices, and Theil and entropy share their
+    w*log(w) sum.
+    """
+    weights = get_weights(scores)
+    n = weights.size
+
+    results: dict[str, float] = dict()
+
+    if "hhi" in indices:
+        results["hhi"] = hhi_from_sums(n, 1.0, np.dot(weights, weights))
+
+    if "gini" in indices:
+        ranked = np.sort(weights)[::-1]
+        results["gini"] = 1.0 + (1.0 - 2.0 * np.dot(np.arange(1, n + 1), ranked)) / n
+
+    if "theil" in indices or "entropy" in indices:
+        non_zero = weights[weights != 0]
+        w_log_w = np.dot(non_zero, np.log(non_zero))
+        results["theil"] = np.log(non_zero.size) + w_log_w
+        results["entropy"] = -w_log_w
+
+    return {i: results[i] for i in indices}
@@ -0,0 +1,232 @@
+import multiprocessing
+import os
+import pathlib
+import re
+
+import numpy as np
+from rdflib import Literal, URIRef
+
+from kgmetrics.terms import BNODE_TAG, LITERAL_TAG, SEPARATOR, URI_TAG, encode_term
+
+# The dialect of Turtle written by lastfm-KG's kgbuilder.py and netflix-KG's parseCSV.py:
+# a header of @prefix lines, blank lines and comments, then one triple per line, as
+# subject, predicate, object and '.' separated by one or more tabs. Terms are <absolute
+# IRIs>, prefixed names, 'a', and "literals" with an optional @lang or ^^datatype.
+# Anything else (blank nodes, ';' and ',' lists, long strings, bare numbers, \u
+# escapes, ...) doesn't match, and the file is left to rdflib.
+PREFIX_LINE = re.compile(
+    r'@prefix\s+([A-Za-z][\w\-.]*)?:\s+<([^<>"{}|^`\\\x00-\x20]*)>\s*\.\s*$'
+)
+IRI = re.compile(r'<([A-Za-z][A-Za-z0-9+.\-]*:[^<>"{}|^`\\\x00-\x20]*)>')
+PREFIXED_NAME = re.compile(
+    r"([A-Za-z][\w\-.]*)?:((?:[\w\-:%]|\.(?=[\w\-:%.]*[\w\-:%]))*)"
+)
+LITERAL = re.compile(
+    r'"((?:[^"\\\n\r]|\\[tbnrf"\'\\])*)"'
+    r"(?:@([A-Za-z]+(?:-[A-Za-z0-9]+)*)|\^\^(\S+))?"
+)
+ESCAPE = re.compile(r"\\(.)")
+ESCAPES = {
+    "t": "\t",
+    "b": "\b",
+    "n": "\n",
+    "r": "\r",
+    "f": "\f",
+    '"': '"',
+    "'": "'",
+    "\\": "\\",
+}
+
+RDF_TYPE = "http://www.w3.org/1999/02/22-rdf-syntax-ns#type"
+XSD_STRING = "http://www.w3.org/2001/XMLSchema#string"
+
+# Files smaller than this are parsed in a single process, whatever nproc is
+MIN_CHUNK_BYTES = 1 << 22
+
+Chunk = tuple[list[str], np.ndarray, dict[str, str]]
+
+
+def parse_chunk(path: pathlib.Path, start: int, end: int) -> Chunk | None:
+    """Splits the lines of a byte range of a file into tokens.
+
+    Returns the chunk's distinct tokens, its triples as an (n, 3) array of indices
+    into them, and the prefixes it declares; or None, if a line doesn't match the
+    dialect.
+    """
+    with open(path, "rb") as f:
+        f.seek(start)
+        text = f.read(end - start).decode("utf-8")
+
+    # runs of tabs are one separator, so that every triple line is 'S\tP\tO\t.'
+    while "\t\t" in text:
+        text = text.replace("\t\t", "\t")
+    lines = text.replace("\r\n", "\n").split("\n")
+
+    prefixes: dict[str, str] = dict()
+    header = 0
+    while header < len(lines) and (
+        not lines[header] or lines[header].isspace() or lines[header][0] in "@#"
+    ):
+        line = lines[header]
+        header += 1
+        if line.startswith("@prefix"):
+            match = PREFIX_LINE.match(line)
+            if match is None:
+                return None
+            prefixes[match.group(1) or ""] = match.group(2)
+
+    triples = list(filter(None, lines[header:]))
+    if not triples:
+        return [], np.zeros((0, 3), dtype=np.int64), prefixes
+    if any(line.count("\t") != 3 or line[0] in "@#" for line in triples):
+        return None
+
+    fields = "\t".join(triples).split("\t")
+    if fields[3::4].count(".") != len(triples):
+        return None
+    del fields[3::4]
+
+    tokens = {t: i for i, t in enumerate(dict.fromkeys(fields))}
+    ids = np.fromiter(
+        map(tokens.__getitem__, fields), dtype=np.int64, count=len(fields)
+    )
+
+    return list(tokens), ids.reshape(-1, 3), prefixes
+
+
+def split_chunks(path: pathlib.Path, nproc: int) -> list[tuple[pathlib.Path, int, int]]:
+    """Byte ranges of about equal size, ending at line breaks."""
+    size = os.path.getsize(path)
+    if nproc <= 1 or size < MIN_CHUNK_BYTES:
+        return [(path, 0, size)]
+
+    bounds = [0]
+    with open(path, "rb") as f:
+        for i in range(1, nproc):
+            f.seek(max(bounds[-1], size * i // nproc))
+            f.readline()
+            bounds.append(f.tell())
+    bounds.append(size)
+
+    return [(path, start, end) for start, end in zip(bounds, bounds[1:]) if start < end]
+
+
+def unescape(value: str) -> str:
+    if "\\" not in value:
+        return value
+    return ESCAPE.sub(lambda m: ESCAPES[m.group(1)], value)
+
+
+def resolve_iri(token: str, prefixes: dict[str, str]) -> str | None:
+    match = IRI.fullmatch(token)
+    if match is not None:
+        return match.group(1)
+
+    match = PREFIXED_NAME.fullmatch(token)
+    if match is not None and (match.group(1) or "") in prefixes:
+        return prefixes[match.group(1) or ""] + match.group(2)
+
+    return None
+
+
+def resolve_term(token: str, prefixes: dict[str, str]) -> bytes | None:
+    """The encoded term of a token, as rdflib's Turtle parser would create it.
+
+    None if the token isn't in the dialect.
+    """
+    if token == "a":
+        return URI_TAG + RDF_TYPE.encode("utf-8")
+
+    if token.startswith('"'):
+        match = LITERAL.fullmatch(token)
+        if match is None:
+            return None
+
+        value, lang, datatype = match.groups()
+        value = unescape(value)
+        if datatype is not None:
+            datatype = resolve_iri(datatype, prefixes)
+            if datatype is None:
+                return None
+
+        # strings are encoded as they are; rdflib normalizes the lexical form of
+        # other literals
+        if lang is None and datatype in (None, XSD_STRING):
+            return (
+                LITERAL_TAG
+                + value.encode("utf-8")
+                + SEPARATOR
+                + SEPARATOR
+                + (datatype or "").encode("utf-8")
+            )
+        return encode_term(
+            Literal(
+                value,
+                lang=lang,
+                datatype=None if datatype is None else URIRef(datatype),
+            )
+        )
+
+    iri = resolve_iri(token, prefixes)
+    return None if iri is None else URI_TAG + iri.encode("utf-8")
+
+
+def parse_triples(
+    path: pathlib.Path, nproc: int = 1
+) -> tuple[list[bytes], np.ndarray] | None:
+    """Parses a KG in the line-oriented dialect into integer-encoded triples.
+
+    Chunks of the file are split into tokens by up to nproc processes; each distinct
+    token is then resolved to a term once, and the triples are mapped to term IDs with
+    array indexing. Returns the byte-sorted term keys (as in a compiled catalog) and
+    the distinct triples as an (n, 3) ID array sorted by (s, p, o), or None if the
+    file isn't in the dialect.
+    """
+    chunks = split_chunks(path, nproc)
+    if len(chunks) == 1:
+        parsed = [parse_chunk(*chunks[0])]
+    else:
+        # fork, so that the workers don't re-import the calling script
+        with multiprocessing.get_context("fork").Pool(min(nproc, len(chunks))) as p:
+            parsed = p.starmap(parse_chunk, chunks)
+
+    if any(chunk is None for chunk in parsed):
+        return None
+
+    prefixes: dict[str, str] = dict()
+    for _, _, chunk_prefixes in parsed:
+        for name, iri in chunk_prefixes.items():
+            if prefixes.setdefault(name, iri) != iri:  # redefined halfway through
+                return None
+
+    # tokens of all chunks, then each chunk's triples in terms of them
+    tokens: dict[str, int] = dict()
+    triples = []
+    for chunk_tokens, chunk_triples, _ in parsed:
+        to_global = np.array(
+            [tokens.setdefault(t, len(tokens)) for t in chunk_tokens], dtype=np.int64
+        )
+        triples.append(to_global[chunk_triples])
+
+    encoded = [resolve_term(t, prefixes) for t in tokens]
+    if any(key is None for key in encoded):
+        return None
+
+    # different tokens may be the same term, e.g. a prefixed name and its full IRI
+    keys = sorted(set(encoded))
+    ids = {k: i for i, k in enumerate(keys)}
+    id_type = np.int32 if len(keys) < np.iinfo(np.int32).max else np.int64
+    token_ids = np.array([ids[k] for k in encoded], dtype=id_type)
+
+    spo = np.concatenate(triples) if triples else np.zeros((0, 3), dtype=np.int64)
+    spo = token_ids[spo]
+    spo = spo[np.lexsort((spo[:, 2], spo[:, 1], spo[:, 0]))]
+    # a Graph is a set
+    spo = spo[np.concatenate(([True], (spo[1:] != spo[:-1]).any(axis=1)))[: len(spo)]]
+
+    # subjects and predicates must be IRIs
+    is_iri = np.array([k[:1] not in (BNODE_TAG, LITERAL_TAG) for k in keys], dtype=bool)
+    if not is_iri[spo[:, 0]].all() or not is_iri[spo[:, 1]].all():
+        return None
+
+    return keys, spo
@@ -0,0 +1,363 @@
+import logging
+import pathlib
+
+import networkx as nx
+import numpy as np
+from rdflib.extras.external_graph_libs import rdflib_to_networkx_digraph
+from rdflib.graph import Graph
+
+from kgmetrics.approximate_centrality import (
+    APPROXIMATE_METRICS,
+    parse_metric,
+    sample_pivot_scores,
+)
+from kgmetrics.concentration import (
+    concentration_indices,
+    hhi_from_sums,
+    split_concentration,
+)
+from kgmetrics.sparse_pagerank import (
+    extend_adjacency,
+    pagerank_scores,
+    weighted_adjacency,
+)
+
+# Metrics that are properties of the whole graph, rather than a concentration of node
+# scores
+STRUCTURAL_METRICS = ["density", "numedges", "numnodes", "avg_degree"]
+
+
+def degree_scores(degree_view, n: int) -> np.ndarray:
+    # Raw degrees; the *_degree_centrality scaling by 1/(n-1) doesn't change any
+    # concentration index
+    return np.fromiter((d for _, d in degree_view), dtype=float, count=n)
+
+
+def centrality_scores(
+    nx_kg: nx.DiGraph, centrality: str
+) -> tuple[np.ndarray, list[np.ndarray] | None]:
+    """Scores of all nodes for a centrality, as an array instead of a dict.
+
+    Sampled centralities (e.g. "betweenness~k=256") also return the scores of each
+    pivot batch, for estimating the error; all others return None for those.
+    """
+    name, options = parse_metric(centrality)
+    n = nx_kg.number_of_nodes()
+
+    if options:
+        if name not in APPROXIMATE_METRICS:
+            raise ValueError(f"{name} can't be approximated!")
+        if options["k"] >= n:
+            # all nodes are pivots, which is exact
+            return sample_pivot_scores(nx_kg, name, **options)[0], None
+        return sample_pivot_scores(nx_kg, name, **options)
+
+    if "betweenness" == name:
+        computed = nx.betweenness_centrality(nx_kg)
+        return np.fromiter(computed.values(), dtype=float, count=n), None
+    if "closeness" == name:
+        computed = nx.closeness_centrality(nx_kg)
+        return np.fromiter(computed.values(), dtype=float, count=n), None
+    if "pagerank" == name:
+        _, A = weighted_adjacency(nx_kg)
+        return pagerank_scores(A)[0], None
+    if "in_degree" == name:
+        return degree_scores(nx_kg.in_degree(), n), None
+    if "out_degree" == name:
+        return degree_scores(nx_kg.out_degree(), n), None
+    if "degree" == name:
+        return degree_scores(nx_kg.degree(), n), None
+
+    raise ValueError("Unsupported metric!")
+
+
+def concentration_error(batch_scores: list[np.ndarray], index: str) -> float:
+    # Standard error of a sampled concentration, from the spread of its batch values
+    batch_values = [
+        concentration_indices(b, [index])[index] for b in batch_scores if b.sum() > 0
+    ]
+    if len(batch_values) < 2:
+        return float("nan")
+
+    return np.std(batch_values, ddof=1) / np.sqrt(len(batch_values))
+
+
+def concentration_with_error(
+    metric: str,
+    scores: np.ndarray,
+    batch_scores: list[np.ndarray] | None,
+    index: str,
+) -> tuple[float, float | None]:
+    """The concentration of a centrality's scores, and its standard error.
+
+    The error is None for exact scores, i.e. without batch scores.
+    """
+    value = concentration_indices(scores, [index])[index]
+    if batch_scores is None:
+        return value, None
+
+    error = concentration_error(batch_scores, index)
+    logging.getLogger(__name__).info(f"{metric} = {value} (standard error {error})")
+
+    return value, error
+
+
+def approximate_concentration(
+    nx_kg: nx.DiGraph, metric: str, k: int, seed: int | None = None, index="hhi"
+) -> tuple[float, float]:
+    # Concentration of sampled centrality scores, and its standard error
+    scores, batch_scores = sample_pivot_scores(nx_kg, metric, k, seed)
+    if k >= nx_kg.number_of_nodes():
+        error = 0.0
+    else:
+        error = concentration_error(batch_scores, index)
+
+    return concentration_indices(scores, [index])[index], error
+
+
+def uses_sampling(metrics: list[str]) -> bool:
+    """Whether any of the metrics is approximated from sampled pivots."""
+    return any(parse_metric(split_concentration(m)[0])[1] for m in metrics)
+
+
+def structural_metric(metric: str, n: int, e: int) -> float:
+    if "density" == metric:
+        return e / (n * (n - 1)) if n > 1 else 0
+    if "numedges" == metric:
+        return e
+    if "numnodes" == metric:
+        return n
+    if "avg_degree" == metric:
+        return e / n
+
+    raise ValueError("Unsupported metric!")
+
+
+def compute_nx_metrics(
+    nx_kg: nx.DiGraph, metrics: list[str], errors: dict[str, float] | None = None
+) -> dict[str, float]:
+    # Each centrality is computed once, however many concentration indices are
+    # requested for it. The standard errors of sampled metrics go to errors, if given.
+    scores: dict[str, tuple] = dict()
+
+    results = dict()
+    for m in metrics:
+        if m in STRUCTURAL_METRICS:
+            results[m] = structural_metric(
+                m, nx_kg.number_of_nodes(), nx_kg.number_of_edges()
+            )
+            continue
+
+        centrality, index = split_concentration(m)
+        if centrality not in scores:
+            scores[centrality] = centrality_scores(nx_kg, centrality)
+        results[m], error = concentration_with_error(m, *scores[centrality], index)
+        if errors is not None and error is not None:
+            errors[m] = error
+
+    return results
+
+
+def compute_nx_metric(nx_kg: nx.DiGraph, metric: str):
+    return compute_nx_metrics(nx_kg, [metric])[metric]
+
+
+def to_networkx(kg: Graph) -> nx.DiGraph:
+    # Converts the triples in sorted order: rdflib iterates in an order that depends
+    # on the process' hash seed, and so would the node order of the networkx graph
+    # and the floating-point sums of its centralities
+    return rdflib_to_networkx_digraph(sorted(kg))
+
+
+def compute_metric(kg: Graph, metric: str):
+    nx_kg = to_networkx(kg)
+
+    return compute_nx_metric(nx_kg, metric)
+
+
+def compute_metrics(kg: Graph | pathlib.Path, metrics: list[str]) -> dict[str, float]:
+    # Parses and converts the KG once for all metrics, instead of once per metric
+    if isinstance(kg, pathlib.Path):
+        path = kg
+        kg = Graph()
+        kg.parse(path)
+
+    nx_kg = to_networkx(kg)
+
+    return compute_nx_metrics(nx_kg, metrics)
+
+
+class IncrementalMetrics:
+    """Metrics for a user sub-KG extended by one recommendation at a time.
+
+    The base graph is converted to networkx once. `apply_delta` adds all triples of
+    an updated graph that are not in the base to that networkx graph in place, and
+    `rollback` removes them again, both in O(delta). Structural metrics and degree
+    HHIs are derived from node/edge counts and degree sums kept alongside. PageRank extends
+    the base's sparse adjacency matrix by the delta and starts from the base's PageRank
+    vector, so it converges in a few iterations. All others run on the updated
+    networkx graph, saving the conversion.
+    """
+
+    def __init__(self, kg: Graph):
+        self._kg = kg
+        self._nx_kg = to_networkx(kg)
+
+        self._num_edges = self._nx_kg.number_of_edges()
+        self._in_squares = sum(d * d for _, d in self._nx_kg.in_degree())
+        self._out_squares = sum(d * d for _, d in self._nx_kg.out_degree())
+        self._degree_squares = sum(d * d for _, d in self._nx_kg.degree())
+
+        self._added_nodes: list = []
+        self._added_edges: list[tuple] = []
+        self._reweighted_edges: list[tuple] = []
+        self._saved_sums: tuple[int, int, int, int] | None = None
+
+        # Built on the first PageRank request: base node index, adjacency and PageRank
+        self._pagerank_index: dict | None = None
+        self._pagerank_adjacency = None
+        self._base_pagerank: np.ndarray | None = None
+
+    @property
+    def graph(self) -> nx.DiGraph:
+        return self._nx_kg
+
+    def _add_edge(self, s, o):
+        nx_kg = self._nx_kg
+
+        for n in dict.fromkeys((s, o)):  # in order, once for a self-loop
+            if n not in nx_kg:
+                nx_kg.add_node(n)
+                self._added_nodes.append(n)
+
+        in_o = nx_kg.in_degree(o)
+        out_s = nx_kg.out_degree(s)
+        deg_s = nx_kg.degree(s)
+        deg_o = nx_kg.degree(o)
+
+        self._num_edges += 1
+        self._in_squares += 2 * in_o + 1
+        self._out_squares += 2 * out_s + 1
+        if s == o:
+            # a self-loop counts twice towards the node's degree
+            self._degree_squares += 4 * deg_s + 4
+        else:
+            self._degree_squares += 2 * deg_s + 1 + 2 * deg_o + 1
+
+        nx_kg.add_edge(s, o, weight=1)
+        self._added_edges.append((s, o))
+
+    def apply_delta(self, delta_kg: Graph):
+        if self._saved_sums is not None:
+            raise RuntimeError("A delta is already applied; call rollback() first")
+
+        self._saved_sums = (
+            self._num_edges,
+            self._in_squares,
+            self._out_squares,
+            self._degree_squares,
+        )
+
+        for s, p, o in sorted(delta_kg):
+            if (s, p, o) in self._kg:
+                continue
+
+            data = self._nx_kg.get_edge_data(s, o)
+            if data is None:
+                self._add_edge(s, o)
+            else:
+                # same as rdflib_to_networkx_digraph: parallel triples add to the weight
+                data["weight"] += 1
+                self._reweighted_edges.append((s, o))
+
+    def rollback(self):
+        if self._saved_sums is None:
+            return
+
+        for s, o in self._reweighted_edges:
+            self._nx_kg[s][o]["weight"] -= 1
+        self._nx_kg.remove_edges_from(self._added_edges)
+        self._nx_kg.remove_nodes_from(self._added_nodes)
+
+        (
+            self._num_edges,
+            self._in_squares,
+            self._out_squares,
+            self._degree_squares,
+        ) = self._saved_sums
+
+        self._added_nodes = []
+        self._added_edges = []
+        self._reweighted_edges = []
+        self._saved_sums = None
+
+    def _warm_pagerank(self) -> np.ndarray:
+        if self._pagerank_index is None:
+            nodelist, A = weighted_adjacency(to_networkx(self._kg))
+            self._pagerank_index = {v: i for i, v in enumerate(nodelist)}
+            self._pagerank_adjacency = A
+            self._base_pagerank, _ = pagerank_scores(A)
+
+        index = dict(self._pagerank_index)
+        for v in self._added_nodes:
+            index[v] = len(index)
+
+        pairs = self._added_edges + self._reweighted_edges
+        rows = [index[s] for s, _ in pairs]
+        cols = [index[o] for _, o in pairs]
+        A = extend_adjacency(
+            self._pagerank_adjacency, len(self._added_nodes), rows, cols
+        )
+
+        # New nodes start with the mass of a uniform vector; the rest keeps the base's
+        # ranking
+        nstart = np.concatenate(
+            [self._base_pagerank, np.repeat(1.0 / len(index), len(self._added_nodes))]
+        )
+        scores, _ = pagerank_scores(A, nstart)
+
+        return scores
+
+    def _centrality_scores(self, centrality: str):
+        if "pagerank" == centrality:
+            return self._warm_pagerank(), None
+
+        return centrality_scores(self._nx_kg, centrality)
+
+    def compute_metrics(
+        self, metrics: list[str], errors: dict[str, float] | None = None
+    ) -> dict[str, float]:
+        """The metrics of the current graph, as compute_nx_metrics would return."""
+        n = self._nx_kg.number_of_nodes()
+        e = self._num_edges
+        degree_sums = {
+            "in_degree": (e, self._in_squares),
+            "out_degree": (e, self._out_squares),
+            "degree": (2 * e, self._degree_squares),
+        }
+
+        scores: dict[str, tuple] = dict()
+
+        results = dict()
+        for m in metrics:
+            if m in STRUCTURAL_METRICS:
+                results[m] = structural_metric(m, n, e)
+                continue
+
+            centrality, index = split_concentration(m)
+            if "hhi" == index and centrality in degree_sums:
+                # Centralities are scaled degrees and HHI is scale-invariant, so
+                # degree sums are enough
+                results[m] = hhi_from_sums(n, *degree_sums[centrality])
+                continue
+
+            if centrality not in scores:
+                scores[centrality] = self._centrality_scores(centrality)
+            results[m], error = concentration_with_error(m, *scores[centrality], index)
+            if errors is not None and error is not None:
+                errors[m] = error
+
+        return results
+
+    def compute_metric(self, metric: str):
+        return self.compute_metrics([metric])[metric]
@@ -0,0 +1,62 @@
+import pathlib
+from typing import Iterator
+
+import rdflib
+
+
+class OverlayGraph:
+    """Read-only view of a base KG plus a delta KG, without copying either.
+
+    Offers the same part of the rdflib Graph API as CatalogStore (triples(),
+    subjects(), objects(), subject_objects(), `in`, len() and iteration), so it can
+    be passed to rdflib_to_networkx_digraph or the metrics like a merged Graph. Only
+    the delta's triples that aren't in the base are kept, so a candidate costs
+    O(delta) instead of a copy of the user's sub-KG.
+    """
+
+    def __init__(self, base: rdflib.Graph, delta: rdflib.Graph):
+        self._base = base
+        self._delta = rdflib.Graph()
+        for triple in delta:
+            if triple not in base:
+                self._delta.add(triple)
+
+    @property
+    def base(self) -> rdflib.Graph:
+        return self._base
+
+    @property
+    def delta(self) -> rdflib.Graph:
+        """The triples of the delta that aren't in the base."""
+        return self._delta
+
+    def __len__(self) -> int:
+        return len(self._base) + len(self._delta)
+
+    def __iter__(self) -> Iterator[tuple]:
+        return self.triples((None, None, None))
+
+    def __contains__(self, triple: tuple) -> bool:
+        return triple in self._base or triple in self._delta
+
+    def triples(self, triple: tuple) -> Iterator[tuple]:
+        yield from self._base.triples(triple)
+        yield from self._delta.triples(triple)
+
+    def subjects(self, predicate=None, object=None, unique=False) -> Iterator:
+        subjects = (s for s, _, _ in self.triples((None, predicate, object)))
+        return iter(set(subjects)) if unique else subjects
+
+    def objects(self, subject=None, predicate=None, unique=False) -> Iterator:
+        objects = (o for _, _, o in self.triples((subject, predicate, None)))
+        return iter(set(objects)) if unique else objects
+
+    def subject_objects(self, predicate=None, unique=False) -> Iterator:
+        pairs = ((s, o) for s, _, o in self.triples((None, predicate, None)))
+        return iter(set(pairs)) if unique else pairs
+
+    def serialize(self, destination: pathlib.Path):
+        """Writes the triples as N-Triples, which are also valid Turtle."""
+        with open(destination, "w", encoding="utf-8") as output:
+            for s, p, o in self:
+                output.write(f"{s.n3()} {p.n3()} {o.n3()} .\n")
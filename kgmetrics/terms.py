@@ -0,0 +1,45 @@
+from functools import lru_cache
+
+import rdflib
+from rdflib import BNode, Literal, URIRef
+
+# Byte encoding of RDF terms, shared by compiled catalogs and delta files: a tag, then
+# the IRI or blank node ID, or the literal's value, language and datatype separated by
+# NULs. Encoded terms sort by kind, then by value.
+URI_TAG = b"U"
+BNODE_TAG = b"B"
+LITERAL_TAG = b"L"
+SEPARATOR = b"\x00"
+
+
+def encode_term(term: rdflib.term.Node) -> bytes:
+    if isinstance(term, Literal):
+        lang = (term.language or "").encode("utf-8")
+        datatype = (term.datatype or "").encode("utf-8")
+        return (
+            LITERAL_TAG
+            + str(term).encode("utf-8")
+            + SEPARATOR
+            + lang
+            + SEPARATOR
+            + datatype
+        )
+    if isinstance(term, BNode):
+        return BNODE_TAG + str(term).encode("utf-8")
+    return URI_TAG + str(term).encode("utf-8")
+
+
+@lru_cache(maxsize=1 << 16)
+def decode_term(key: bytes) -> rdflib.term.Node:
+    kind, value = key[:1], key[1:]
+
+    if kind == LITERAL_TAG:
+        value, lang, datatype = value.split(SEPARATOR)
+        return Literal(
+            value.decode("utf-8"),
+            lang=lang.decode("utf-8") or None,
+            datatype=datatype.decode("utf-8") or None,
+        )
+    if kind == BNODE_TAG:
+        return BNode(value.decode("utf-8"))
+    return URIRef(value.decode("utf-8"))
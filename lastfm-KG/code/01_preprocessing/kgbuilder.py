@@ -1,9 +1,20 @@
-from collections import defaultdict
+from collections import defaultdict, deque
 import csv
+import heapq
+import itertools
 import os
 import pathlib
 import sys
+import tempfile
+import typing
 from argparse import ArgumentParser
+from multiprocessing import Pool
+
+import numpy as np
+import rdflib
+
+from kgmetrics.catalog_store import save_catalog
+from kgmetrics.terms import encode_term
 
 MO_CLASSES = {"track": "mo:Track", "artist": "mo:MusicArtist", "genre": "mo:Genre"}
 MO_PROPS = {"genre": "mo:genre"}
@@ -18,6 +29,32 @@ PREFIXES = {
     "mo": "http://purl.org/ontology/mo/",
     "xsd": "http://www.w3.org/2001/XMLSchema#",
 }
+RDF_TYPE = "http://www.w3.org/1999/02/22-rdf-syntax-ns#type"
+
+# Streaming mode: output formats, artists per batch of work, and rows per sorted run of
+# the external sort
+FORMATS = ["ttl", "nt", "binary"]
+DEFAULT_BATCH_SIZE = 1000
+DEFAULT_SORT_BUFFER = 1_000_000
+
+
+class Row(typing.NamedTuple):
+    track_id: str
+    track_name: str
+    artist_id: str
+    artist_name: str
+    genres: list[str]
+
+
+class Artist(typing.NamedTuple):
+    artist_id: str
+    name: str
+    # track ID -> (name, genres), in the order of their first row
+    tracks: dict[str, tuple[str, list[str]]]
+
+
+class Literal(str):
+    """A literal object; all other terms are prefixed names."""
 
 
 def run(input: pathlib.Path, output: pathlib.Path) -> int:
@@ -85,6 +122,256 @@ def run(input: pathlib.Path, output: pathlib.Path) -> int:
     return os.EX_OK
 
 
+def read_rows(input: pathlib.Path) -> typing.Iterator[Row]:
+    with open(input, "r", newline="") as f:
+        reader = csv.DictReader(f, fieldnames=next(f).strip().split(","))
+
+        for r in reader:
+            yield Row(
+                r["compound"].strip(),
+                r["track_name"].strip(),
+                r["artist_id"].strip(),
+                r["artist_name"].strip(),
+                [g.strip() for g in r["genres"].strip().split("|") if g.strip()],
+            )
+
+
+def sort_rows(
+    rows: typing.Iterable[Row], tmp_dir: pathlib.Path, buffer_size: int
+) -> typing.Iterator[Row]:
+    """Rows sorted by artist, with an external merge sort.
+
+    Runs of buffer_size rows are sorted in memory and written to tmp_dir, then merged.
+    The sort is stable, so an artist's rows keep their order.
+    """
+    runs = []
+    rows = iter(rows)
+    while chunk := list(itertools.islice(rows, buffer_size)):
+        chunk.sort(key=lambda r: r.artist_id)
+
+        run_file = tmp_dir / f"run-{len(runs):06d}.csv"
+        with open(run_file, "w", newline="") as f:
+            writer = csv.writer(f)
+            for r in chunk:
+                writer.writerow(r[:4] + ("|".join(r.genres),))
+        runs.append(run_file)
+
+    def read_run(run_file: pathlib.Path) -> typing.Iterator[Row]:
+        with open(run_file, "r", newline="") as f:
+            for t_id, t_name, a_id, a_name, genres in csv.reader(f):
+                yield Row(
+                    t_id, t_name, a_id, a_name, genres.split("|") if genres else []
+                )
+
+    # ties are taken from the earlier run first, which keeps the sort stable
+    yield from heapq.merge(*map(read_run, runs), key=lambda r: r.artist_id)
+
+
+def group_artists(rows: typing.Iterable[Row]) -> typing.Iterator[Artist]:
+    """Consecutive rows of the same artist, as one Artist.
+
+    As in run, the last row's names win and a track's genres are those of all its
+    rows. Unlike run, this holds per artist: a track that several artists list under
+    different names gets a title from each of them, where run keeps the last one.
+    """
+    for a_id, artist_rows in itertools.groupby(rows, key=lambda r: r.artist_id):
+        a_name = ""
+        tracks: dict[str, tuple[str, list[str]]] = dict()
+        for r in artist_rows:
+            a_name = r.artist_name
+            genres = tracks[r.track_id][1] if r.track_id in tracks else []
+            tracks[r.track_id] = (r.track_name, genres + r.genres)
+
+        yield Artist(a_id, a_name, tracks)
+
+
+def genre_triples(genre: str) -> list[tuple[str, str, str]]:
+    return [
+        (f"lfmr:{genre}", "a", MO_CLASSES["genre"]),
+        (f"lfmr:{genre}", DC_PROPS["title"], Literal(genre)),
+    ]
+
+
+def artist_triples(artist: Artist) -> typing.Iterator[tuple[str, str, str]]:
+    yield f"lfmr:{artist.artist_id}", "a", MO_CLASSES["artist"]
+    yield f"lfmr:{artist.artist_id}", FOAF_PROPS["name"], Literal(artist.name)
+
+    for t_id, (t_name, genres) in artist.tracks.items():
+        # prefix track-IDs to avoid collisions with artists that have same ID
+        t_id_pref = f"lfmr:t_{t_id}"
+
+        yield t_id_pref, "a", MO_CLASSES["track"]
+        yield t_id_pref, DC_PROPS["title"], Literal(t_name)
+        yield t_id_pref, FOAF_PROPS["maker"], f"lfmr:{artist.artist_id}"
+        for genre in dict.fromkeys(genres):
+            yield t_id_pref, MO_PROPS["genre"], f"lfmr:{genre}"
+
+
+def expand(term: str) -> str:
+    if term == "a":
+        return RDF_TYPE
+    prefix, local = term.split(":", 1)
+    return PREFIXES[prefix] + local
+
+
+def format_ttl(triples: typing.Iterable[tuple[str, str, str]]) -> str:
+    lines = []
+    for s, p, o in triples:
+        if isinstance(o, Literal):
+            o = '"' + o.replace(r'"', r"\"") + '"'
+        lines.append(f"{s}\t\t{p}\t\t{o}\t\t.\n")
+    return "".join(lines)
+
+
+def format_nt(triples: typing.Iterable[tuple[str, str, str]]) -> str:
+    lines = []
+    for s, p, o in triples:
+        if isinstance(o, Literal):
+            o = (
+                o.replace("\\", "\\\\")
+                .replace('"', '\\"')
+                .replace("\n", "\\n")
+                .replace("\r", "\\r")
+            )
+            o = f'"{o}"'
+        else:
+            o = f"<{expand(o)}>"
+        lines.append(f"<{expand(s)}> <{expand(p)}> {o} .\n")
+    return "".join(lines)
+
+
+def to_node(term: str) -> rdflib.term.Node:
+    if isinstance(term, Literal):
+        return rdflib.Literal(str(term))
+    return rdflib.URIRef(expand(term))
+
+
+def encode_triples(
+    triples: typing.Iterable[tuple[str, str, str]]
+) -> tuple[list[bytes], np.ndarray]:
+    """Distinct encoded terms, and the triples as an (n, 3) array of indices into them."""
+    keys: dict[bytes, int] = dict()
+    ids = [
+        keys.setdefault(encode_term(to_node(t)), len(keys))
+        for triple in triples
+        for t in triple
+    ]
+    return list(keys), np.array(ids, dtype=np.int64).reshape(-1, 3)
+
+
+def build_batch(fmt: str, genres: list[str], artists: list[Artist]):
+    """The output of new genres and a batch of artists, in the given format."""
+    triples = itertools.chain(
+        (t for genre in genres for t in genre_triples(genre)),
+        (t for artist in artists for t in artist_triples(artist)),
+    )
+
+    if "nt" == fmt:
+        return format_nt(triples)
+    if "binary" == fmt:
+        return encode_triples(triples)
+    return format_ttl(triples)
+
+
+def batches(
+    artists: typing.Iterable[Artist], batch_size: int
+) -> typing.Iterator[tuple[list[str], list[Artist]]]:
+    """Batches of artists, each with the genres that no earlier batch has."""
+    seen_genres: set[str] = set()
+    artists = iter(artists)
+    while batch := list(itertools.islice(artists, batch_size)):
+        genres = dict.fromkeys(
+            genre
+            for artist in batch
+            for _, track_genres in artist.tracks.values()
+            for genre in track_genres
+            if genre not in seen_genres
+        )
+        seen_genres.update(genres)
+        yield list(genres), batch
+
+
+def convert(work: typing.Iterable[tuple], nproc: int) -> typing.Iterator:
+    """build_batch over the work, in order, with at most 2 * nproc batches in flight."""
+    if nproc <= 1:
+        yield from itertools.starmap(build_batch, work)
+        return
+
+    with Pool(nproc) as p:
+        pending: deque = deque()
+        for args in work:
+            pending.append(p.apply_async(build_batch, args))
+            if len(pending) >= 2 * nproc:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+
+
+def stream(
+    input: pathlib.Path,
+    output: pathlib.Path,
+    fmt: str = "ttl",
+    nproc: int = 1,
+    sort: bool = False,
+    sort_buffer: int = DEFAULT_SORT_BUFFER,
+    batch_size: int = DEFAULT_BATCH_SIZE,
+) -> int:
+    """Builds the KG in one pass over the input, artist by artist.
+
+    An artist's rows must be consecutive, unless sort is set; then the input is
+    sorted by artist first, with an external sort in a temporary directory next to
+    the output. For ttl and nt, only the rows of the artists in flight are kept in
+    memory. The binary format isn't bounded like that: the term dictionary grows
+    with the KG, and while triples are spilled to disk during the pass, compiling the
+    store at the end loads and sorts all of them, as catalog_store.py would. With
+    nproc workers, batches of artists are converted in parallel and written in order.
+    """
+    with tempfile.TemporaryDirectory(dir=output.parent) as tmp:
+        tmp_dir = pathlib.Path(tmp)
+
+        rows = read_rows(input)
+        if sort:
+            rows = sort_rows(rows, tmp_dir, sort_buffer)
+        work = (
+            (fmt, genres, artists)
+            for genres, artists in batches(group_artists(rows), batch_size)
+        )
+
+        if "binary" == fmt:
+            keys: dict[bytes, int] = dict()
+            with open(tmp_dir / "triples.bin", "wb") as f:
+                for batch_keys, batch_triples in convert(work, nproc):
+                    to_global = np.array(
+                        [keys.setdefault(k, len(keys)) for k in batch_keys],
+                        dtype=np.int64,
+                    )
+                    to_global[batch_triples].tofile(f)
+
+            # IDs in byte-order of the terms, as the store's dictionary needs them
+            sorted_keys = sorted(keys)
+            id_type = np.int32 if len(keys) < np.iinfo(np.int32).max else np.int64
+            remap = np.empty(len(keys), dtype=id_type)
+            remap[[keys[k] for k in sorted_keys]] = np.arange(len(keys), dtype=id_type)
+            del keys
+
+            spo = remap[
+                np.fromfile(tmp_dir / "triples.bin", dtype=np.int64).reshape(-1, 3)
+            ]
+            save_catalog(sorted_keys, spo, output)
+            return os.EX_OK
+
+        with open(output, "w") as f:
+            if "ttl" == fmt:
+                for alias, uri in PREFIXES.items():
+                    f.write(f"@prefix {alias}: <{uri}> .\n")
+                f.write("\n")
+
+            for text in convert(work, nproc):
+                f.write(text)
+
+    return os.EX_OK
+
+
 if __name__ == "__main__":
     parser = ArgumentParser()
     parser.add_argument(
@@ -93,6 +380,57 @@ if __name__ == "__main__":
     parser.add_argument(
         "--output", type=pathlib.Path, help="Destination to write RDF triples to"
     )
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="Write triples in one pass over the input, artist by artist, instead of "
+        "collecting all of them in memory first; the input must be grouped by artist, "
+        "unless --sort is given. Implied by all options below",
+    )
+    parser.add_argument(
+        "--sort",
+        action="store_true",
+        help="Sort the input by artist first, with an external sort",
+    )
+    parser.add_argument(
+        "--sort-buffer",
+        type=int,
+        default=DEFAULT_SORT_BUFFER,
+        help="Rows per sorted run of the external sort",
+    )
+    parser.add_argument(
+        "--format",
+        choices=FORMATS,
+        default="ttl",
+        help="ttl (default), nt (N-Triples), or binary: a compiled catalog directory, "
+        "as written by 03_rerank/catalog_store.py; unlike the text formats, it needs "
+        "memory for all triples when the store is compiled at the end",
+    )
+    parser.add_argument(
+        "--nproc",
+        type=int,
+        default=1,
+        help="Number of workers converting batches of artists",
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=DEFAULT_BATCH_SIZE,
+        help="Artists per batch",
+    )
     args = parser.parse_args()
 
+    if args.stream or args.sort or args.format != "ttl" or args.nproc > 1:
+        sys.exit(
+            stream(
+                args.input,
+                args.output,
+                args.format,
+                args.nproc,
+                args.sort,
+                args.sort_buffer,
+                args.batch_size,
+            )
+        )
+
     sys.exit(run(args.input, args.output))
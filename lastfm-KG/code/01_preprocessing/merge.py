@@ -1,25 +1,24 @@
 import argparse
 import csv
+import io
+import itertools
 import lzma
 import logging
 import os
 import pathlib
+import shutil
+import subprocess
 import sys
+import time
 import typing
+from collections import deque
+from multiprocessing import Pool
 
+import numpy as np
 import pandas as pd
 from sklearn.preprocessing import MinMaxScaler
 
 
-class Record(typing.NamedTuple):
-    compound: str
-    track_id: str
-    track_name: str
-    artist_id: str
-    artist_name: str
-    genres: str
-
-
 class ListeningEvent(typing.NamedTuple):
     user_id: str
     artist_id: str
@@ -28,46 +27,102 @@ class ListeningEvent(typing.NamedTuple):
     timestamp: str
 
 
-def read_genres(genres_path: pathlib.Path) -> pd.DataFrame:
-    data = []
-    with open(genres_path, "r") as f:
-        next(f)
-        # format: track_id TAB track TAB artist_id TAB artist TAB LFM-2b_playcount TAB genre
-        for line in f:
-            line = line.strip()
-            if len(line) == 0:
-                continue
-
-            # column 1
-            #   - track-IDs joined by `_`; all IDs that refer to the same track
-            # column 5
-            #   - LFM2b playcount, which we don't need and hence drop
-            # columns 6+
-            #   - (genre, weight) tuples separated by tabs; aggregate in a list and clean later
-            track_id, track_name, artist_id, artist_name, _, *genres = line.split("\t")
-
-            # genre names are at odd indices, weights at even indices; only keep the odds
-            genres = {g.strip() for g in genres[0::2]}
-            genres = "|".join(genres)
-
-            for single in track_id.split("_"):
-                data.append(
-                    Record(
-                        track_id, single, track_name, artist_id, artist_name, genres
-                    )._asdict()
-                )
-    df = pd.DataFrame(data)
+GENRE_COLUMNS = [
+    "compound",
+    "track_id",
+    "track_name",
+    "artist_id",
+    "artist_name",
+    "genres",
+]
+
+# Lines of the genre file that are parsed at once
+GENRE_CHUNK_LINES = 1 << 16
+
+# Decompressed bytes of listening events per chunk that a worker filters at once
+LFM_CHUNK_BYTES = 64 << 20
+
+
+def parse_genre_lines(lines: list[str]) -> pd.DataFrame:
+    """Parses lines of the genre file into one row per single track ID."""
+    # format: track_id TAB track TAB artist_id TAB artist TAB LFM-2b_playcount TAB genre
+    #
+    # column 1
+    #   - track-IDs joined by `_`; all IDs that refer to the same track
+    # column 5
+    #   - LFM2b playcount, which we don't need and hence drop
+    # columns 6+
+    #   - (genre, weight) tuples separated by tabs, kept as one string here
+    lines = pd.Series([line for line in map(str.strip, lines) if line], dtype=object)
+    if lines.empty:
+        return pd.DataFrame(columns=GENRE_COLUMNS).astype({"track_id": "int64"})
+
+    fields = lines.str.split("\t", n=5, expand=True)
+    if fields.shape[1] < 5 or fields[4].isna().any():
+        raise ValueError("Expected at least 5 tab-separated fields per genre line")
+    rest = fields[5] if fields.shape[1] == 6 else pd.Series("", index=fields.index)
+
+    df = pd.DataFrame(
+        {
+            "compound": fields[0],
+            "track_id": fields[0].str.split("_"),
+            "track_name": fields[1],
+            "artist_id": fields[2],
+            "artist_name": fields[3],
+            # genre names are at odd indices, weights at even indices; only keep the
+            # odds. The names are joined in set order, as they always have been
+            "genres": [
+                "|".join({g.strip() for g in r.split("\t")[0::2]}) if r else ""
+                for r in rest.fillna("")
+            ],
+        }
+    )
+    df = df.explode("track_id", ignore_index=True)
     df["track_id"] = df["track_id"].astype("int64")
 
     return df
 
 
+def read_genres(
+    genres_path: pathlib.Path, chunk_lines: int = GENRE_CHUNK_LINES
+) -> pd.DataFrame:
+    """Reads the genre file into one row per single track ID.
+
+    The file is parsed in chunks of `chunk_lines` lines with vectorized string
+    operations, so that only a chunk's worth of intermediate objects is alive at a
+    time besides the parsed frames.
+    """
+    chunks = []
+    with open(genres_path, "r") as f:
+        next(f)
+        while lines := list(itertools.islice(f, chunk_lines)):
+            chunks.append(parse_genre_lines(lines))
+            del lines
+
+    if not chunks:
+        return parse_genre_lines([])
+    if len(chunks) == 1:
+        return chunks[0]
+
+    # the strings are shared by the chunks and the frame, only the arrays of
+    # references to them are copied
+    columns = {
+        name: np.concatenate([chunk[name].to_numpy() for chunk in chunks])
+        for name in GENRE_COLUMNS
+    }
+    del chunks
+
+    # without consolidating the object columns into one block, which would copy them
+    return pd.DataFrame(columns, copy=False)
+
+
 def run(
     genres_path: pathlib.Path,
     features_path: pathlib.Path,
     lfm_path: pathlib.Path,
     features_out: pathlib.Path,
     lfm_out: pathlib.Path,
+    nproc: int = 1,
 ) -> int:
     logger = logging.getLogger(__name__)
 
@@ -107,38 +162,169 @@ def run(
         return os.EX_OK
 
     logger.info("Building track-compound index...")
-    track_id_to_compound = dict(zip(df["track_id"].astype(str), df["compound"]))
+    # as a dict would, the last compound of a track wins
+    track_id_to_compound = pd.Series(
+        df["compound"].values, index=df["track_id"].astype(str)
+    )
+    track_id_to_compound = track_id_to_compound[
+        ~track_id_to_compound.index.duplicated(keep="last")
+    ]
     logger.info("done!")
 
     logger.info("Filtering listening events to featureset...")
-    n_records = 0
-    with lzma.open(lfm_path, "rt") as fin:
+    n_events = filter_events(lfm_path, lfm_out, track_id_to_compound, nproc)
+    logger.info(f"Done. Wrote {n_events} lines to {lfm_out}")
+
+    return os.EX_OK
 
-        with open(lfm_out, "w") as fout:
-            writer = csv.DictWriter(fout, fieldnames=ListeningEvent._fields)
-            writer.writeheader()
 
-            for line in fin:
-                if n_records % 1_000_000 == 0:
-                    logger.info(f"wrote {n_records} records so far")
-                line = line.strip()
-                if len(line) == 0:
-                    continue
-                record = ListeningEvent._make(line.split("\t"))
+def open_xz(lfm_path: pathlib.Path, nproc: int):
+    """The decompressed file, and the xz process decompressing it, if any.
 
-                try:
-                    record = record._replace(
-                        track_id=track_id_to_compound[record.track_id]
-                    )
-                except KeyError:
-                    continue
+    xz decompresses the blocks of multi-block files (as written by `xz -T`) in up to
+    nproc threads; without xz on the PATH, lzma decompresses in this process.
+    """
+    xz = shutil.which("xz")
+    if xz is None:
+        return lzma.open(lfm_path, "rb"), None
 
-                writer.writerow(record._asdict())
-                n_records += 1
+    process = subprocess.Popen(
+        [xz, "--decompress", "--stdout", f"--threads={nproc}", str(lfm_path)],
+        stdout=subprocess.PIPE,
+        bufsize=LFM_CHUNK_BYTES,
+    )
+    return process.stdout, process
+
+
+def read_chunks(f: typing.BinaryIO, chunk_bytes: int) -> typing.Iterator[bytes]:
+    """Chunks of about chunk_bytes, ending at line breaks."""
+    rest = b""
+    while block := f.read(chunk_bytes):
+        block = rest + block
+        end = block.rfind(b"\n") + 1
+        if end == 0:  # a single, very long line
+            rest = block
+            continue
+        rest = block[end:]
+        yield block[:end]
+    if rest:
+        yield rest
+
+
+def init_filter(index: pd.Series, fmt: str):
+    # Workers receive the index once, instead of with every chunk
+    global track_id_to_compound, output_format
+    track_id_to_compound = index
+    output_format = fmt
+
+
+def filter_chunk(chunk: bytes) -> tuple[int, int, bytes | pd.DataFrame]:
+    """Listening events of a chunk whose track is in the index, with its compound.
+
+    Returns the chunk's size and number of events, and the kept events as CSV
+    (without header) or as a DataFrame, for the Parquet format.
+    """
+    if not chunk.strip():
+        kept = pd.DataFrame(columns=list(ListeningEvent._fields), dtype=str)
+        return len(chunk), 0, kept if "parquet" == output_format else b""
+
+    events = pd.read_csv(
+        io.BytesIO(chunk),
+        sep="\t",
+        header=None,
+        names=ListeningEvent._fields,
+        dtype=str,
+        quoting=csv.QUOTE_NONE,
+        na_filter=False,
+    )
 
-    logger.info(f"Done. Wrote {n_records} lines to {lfm_out}")
+    compounds = events["track_id"].map(track_id_to_compound)
+    kept = events[compounds.notna()].assign(track_id=compounds.dropna())
 
-    return os.EX_OK
+    if "parquet" == output_format:
+        return len(chunk), len(events), kept.reset_index(drop=True)
+    return (
+        len(chunk),
+        len(events),
+        kept.to_csv(header=False, index=False, lineterminator="\r\n").encode("utf-8"),
+    )
+
+
+def filter_events(
+    lfm_path: pathlib.Path,
+    lfm_out: pathlib.Path,
+    track_id_to_compound: pd.Series,
+    nproc: int = 1,
+) -> int:
+    """Writes the listening events of tracks in the index, with their compound.
+
+    Decompressed chunks are parsed and joined against the index by nproc workers, and
+    written in order: as CSV, or as Parquet if lfm_out ends in .parquet (needs
+    pyarrow). Returns the number of events written.
+    """
+    logger = logging.getLogger(__name__)
+
+    fmt = "parquet" if lfm_out.suffix == ".parquet" else "csv"
+    fin, xz = open_xz(lfm_path, nproc)
+
+    if "parquet" == fmt:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        schema = pa.schema([(f, pa.string()) for f in ListeningEvent._fields])
+        writer = pq.ParquetWriter(lfm_out, schema)
+
+        def write(kept: pd.DataFrame):
+            writer.write_table(
+                pa.Table.from_pandas(kept, schema=schema, preserve_index=False)
+            )
+
+    else:
+        fout = open(lfm_out, "wb")
+        fout.write((",".join(ListeningEvent._fields) + "\r\n").encode("utf-8"))
+        write = fout.write
+
+    n_bytes = n_events = n_kept = 0
+    start = time.perf_counter()
+    with Pool(
+        nproc, initializer=init_filter, initargs=(track_id_to_compound, fmt)
+    ) as p:
+        # at most 2 * nproc chunks in flight, so that memory stays bounded
+        pending: deque = deque()
+
+        def collect():
+            nonlocal n_bytes, n_events, n_kept
+            chunk_bytes, chunk_events, kept = pending.popleft().get()
+            write(kept)
+
+            n_bytes += chunk_bytes
+            n_events += chunk_events
+            n_kept += len(kept) if "parquet" == fmt else kept.count(b"\n")
+
+            elapsed = time.perf_counter() - start
+            logger.info(
+                f"{n_events} events read, {n_kept} kept; "
+                f"{n_events / elapsed:,.0f} events/s, "
+                f"{n_bytes / elapsed / (1 << 20):.1f} MB/s decompressed"
+            )
+
+        for chunk in read_chunks(fin, LFM_CHUNK_BYTES):
+            pending.append(p.apply_async(filter_chunk, (chunk,)))
+            if len(pending) >= 2 * nproc:
+                collect()
+        while pending:
+            collect()
+
+    fin.close()
+    if xz is not None and xz.wait() != 0:
+        raise RuntimeError(f"xz failed to decompress {lfm_path}")
+
+    if "parquet" == fmt:
+        writer.close()
+    else:
+        fout.close()
+
+    return n_kept
 
 
 if __name__ == "__main__":
@@ -152,7 +338,27 @@ if __name__ == "__main__":
     parser.add_argument("--features", type=pathlib.Path, required=True)
     parser.add_argument("--lfm", type=pathlib.Path, required=True)
     parser.add_argument("--features-out", type=pathlib.Path, required=True)
-    parser.add_argument("--lfm-out", type=pathlib.Path, required=True)
+    parser.add_argument(
+        "--lfm-out",
+        type=pathlib.Path,
+        required=True,
+        help="CSV, or Parquet if it ends in .parquet",
+    )
+    parser.add_argument(
+        "--nproc",
+        type=int,
+        default=1,
+        help="Number of workers decompressing and filtering listening events",
+    )
     args = parser.parse_args()
 
-    sys.exit(run(args.genres, args.features, args.lfm, args.features_out, args.lfm_out))
+    sys.exit(
+        run(
+            args.genres,
+            args.features,
+            args.lfm,
+            args.features_out,
+            args.lfm_out,
+            args.nproc,
+        )
+    )
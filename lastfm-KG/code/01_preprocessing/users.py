@@ -1,12 +1,164 @@
 import argparse
 import csv
+import io
 import logging
 import os
 import pathlib
 import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
 
+import numpy as np
 import pandas as pd
-from sklearn.preprocessing import MinMaxScaler
+
+PLAYCOUNT_COLUMNS = ["user_id", "track_id", "count"]
+PLAYCOUNT_DTYPES = {"user_id": "int64", "track_id": "string", "count": "uint16"}
+
+# Playcount-files that are parsed at once; throughput is logged after each batch
+PLAYCOUNT_BATCH_FILES = 1000
+
+# Range that each user's playcounts are scaled to, as sklearn's MinMaxScaler would
+RATING_RANGE = (1, 1000)
+
+
+def scale_counts(user_ids: pd.Series, counts: pd.Series) -> np.ndarray:
+    """Min-max scales the counts of each user to RATING_RANGE.
+
+    The same arithmetic as a MinMaxScaler fitted on each user's counts, including
+    users whose counts are all the same, which are scaled to the lower bound.
+    """
+    grouped = counts.groupby(user_ids, sort=False)
+    data_min = grouped.transform("min").to_numpy(dtype=np.float64)
+    data_range = grouped.transform("max").to_numpy(dtype=np.float64) - data_min
+    data_range[data_range < 10 * np.finfo(np.float64).eps] = 1.0
+
+    low, high = RATING_RANGE
+    scale = (high - low) / data_range
+
+    return counts.to_numpy(dtype=np.float64) * scale + (low - data_min * scale)
+
+
+def parse_playcounts(text: bytes) -> pd.DataFrame:
+    """Parses the (concatenated) contents of playcount-files."""
+    if not text.strip():
+        return pd.DataFrame(
+            {
+                name: pd.Series(dtype=PLAYCOUNT_DTYPES[name])
+                for name in PLAYCOUNT_COLUMNS
+            }
+        )
+
+    return pd.read_csv(
+        io.BytesIO(text),
+        header=None,
+        names=PLAYCOUNT_COLUMNS,
+        dtype=PLAYCOUNT_DTYPES,
+    )
+
+
+def read_file(path: pathlib.Path) -> bytes:
+    text = path.read_bytes()
+    return text if not text or text.endswith(b"\n") else text + b"\n"
+
+
+def load_playcounts(
+    tmpdir: pathlib.Path, users: pd.Series, io_threads: int | None = None
+) -> pd.DataFrame:
+    """Reads and concatenates the playcount-files of users, in the order of users.
+
+    Files are read by a pool of io_threads threads (ThreadPoolExecutor's default if
+    None), so that the latency of opening and reading many small files overlaps. The
+    files have no header, so each batch of PLAYCOUNT_BATCH_FILES files is parsed in a
+    single call, rather than paying pandas' overhead per file.
+    """
+    logger = logging.getLogger(__name__)
+
+    paths = [tmpdir / (str(user) + ".playcounts.csv") for user in users]
+    n_files = 0
+    n_bytes = 0
+    data: list[pd.DataFrame] = []
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(io_threads) as executor:
+        for i in range(0, len(paths), PLAYCOUNT_BATCH_FILES):
+            batch = paths[i : i + PLAYCOUNT_BATCH_FILES]
+            text = b"".join(executor.map(read_file, batch))
+            data.append(parse_playcounts(text))
+
+            n_files += len(batch)
+            n_bytes += len(text)
+            log_throughput(logger, n_files, n_bytes, start)
+
+    if not data:
+        return parse_playcounts(b"")
+    if len(data) == 1:
+        return data[0]
+
+    return pd.concat(data, ignore_index=True)
+
+
+def log_throughput(logger: logging.Logger, n_files: int, n_bytes: int, start: float):
+    elapsed = max(time.perf_counter() - start, 1e-9)
+    logger.info(
+        f"Read {n_files} playcount-files ({n_bytes / 2**20:.1f} MB) in {elapsed:.1f}s: "
+        f"{n_files / elapsed:.0f} files/s, {n_bytes / 2**20 / elapsed:.1f} MB/s"
+    )
+
+
+def read_consolidated_playcounts(path: pathlib.Path, users: pd.Series) -> pd.DataFrame:
+    """The users' playcounts from a consolidated Parquet file, as load_playcounts
+    would read them from the playcount-files.
+
+    Only the row groups that may hold the users are read; rows are then put in the
+    order of users, keeping the order of each user's rows.
+    """
+    logger = logging.getLogger(__name__)
+
+    start = time.perf_counter()
+    playcounts = pd.read_parquet(
+        path, columns=PLAYCOUNT_COLUMNS, filters=[("user_id", "in", list(users))]
+    ).astype(PLAYCOUNT_DTYPES)
+
+    position = pd.Index(users).get_indexer(playcounts["user_id"])
+    playcounts = playcounts.take(np.argsort(position, kind="stable"))
+    elapsed = max(time.perf_counter() - start, 1e-9)
+    logger.info(
+        f"Read {len(playcounts)} playcounts of {len(users)} users in {elapsed:.1f}s"
+    )
+
+    return playcounts.reset_index(drop=True)
+
+
+def format_rows(table: pd.DataFrame) -> tuple[str, np.ndarray]:
+    """The header and each row of a table as CSV lines, as csv.DictWriter writes them."""
+    fout = io.StringIO()
+    writer = csv.writer(fout)
+    # writerow returns the number of characters written
+    lengths = [writer.writerow(table.columns)]
+    lengths.extend(writer.writerow(row) for row in table.itertuples(index=False))
+    text = fout.getvalue()
+
+    offsets = np.cumsum([0] + lengths)
+    lines = np.array(
+        [text[start:end] for start, end in zip(offsets[:-1], offsets[1:])],
+        dtype=object,
+    )
+
+    return lines[0], lines[1:]
+
+
+def read_feature_table(features_path: pathlib.Path) -> pd.DataFrame:
+    """The rows of the feature-file as they are written, indexed by compound.
+
+    Values are kept as the strings in the file, so that histories are written as
+    they were read. If a compound is in the file more than once, its last row wins.
+    """
+    features = pd.read_csv(
+        features_path, dtype=str, keep_default_na=False, na_filter=False
+    )
+    features = features.drop_duplicates("compound", keep="last")
+
+    return features.set_index(features["compound"].rename(None))
 
 
 def run(
@@ -16,6 +168,9 @@ def run(
     tmpdir: pathlib.Path,
     scaled_out: pathlib.Path,
     features_path: pathlib.Path,
+    packed_out: pathlib.Path | None = None,
+    playcounts_path: pathlib.Path | None = None,
+    io_threads: int | None = None,
 ) -> int:
     logger = logging.getLogger(__name__)
 
@@ -36,64 +191,89 @@ def run(
     df = df.sample(n=num_users, random_state=666)
     logger.info(f"User sample contains {len(df)} users")
 
-    logger.info(f"Writing sample to {sample_out}")
-    df.to_csv(sample_out, index=False)
-
     logger.info("Building full frame of all users in sample")
-    data: list[pd.DataFrame] = []
-    for user in df["user_id"]:
-        path = tmpdir / (str(user) + ".playcounts.csv")
-        data.append(
-            pd.read_csv(
-                path,
-                header=None,
-                names=["user_id", "track_id", "count"],
-                dtype={"user_id": "int64", "track_id": "string", "count": "uint16"},
+    sample_playcounts = None
+    if playcounts_path is not None and playcounts_path.exists():
+        logger.info(f"Reading playcounts from {playcounts_path}")
+        sample_playcounts = read_consolidated_playcounts(playcounts_path, df["user_id"])
+
+        missing = ~df["user_id"].isin(sample_playcounts["user_id"])
+        if missing.any():
+            logger.info(
+                f"{missing.sum()} users of the sample aren't in {playcounts_path}, "
+                "rebuilding it"
             )
-        )
+            sample_playcounts = None
 
-    logger.info(f"Collected {len(data)} sub-dataframes")
-    sample_playcounts = pd.concat(data)
+    if sample_playcounts is None:
+        # only the sample's playcount-files are read, not those of all eligible users
+        sample_playcounts = load_playcounts(tmpdir, df["user_id"], io_threads)
+
+        if playcounts_path is not None:
+            logger.info(
+                f"Consolidating playcounts of {len(df)} sampled users into "
+                f"{playcounts_path}"
+            )
+            # sorted by user, so that reading a sample can skip row groups
+            sample_playcounts.sort_values("user_id", kind="stable").to_parquet(
+                playcounts_path, index=False
+            )
 
     logger.info("Scaling implicit counts to ratings in (1,1000)")
+    df_scaled = sample_playcounts.assign(
+        rating=scale_counts(sample_playcounts["user_id"], sample_playcounts["count"])
+    )
 
-    scaler = MinMaxScaler(feature_range=(1, 1000))
+    logging.info(f"Reading feature-file {features_path} into memory")
+    feature_table = read_feature_table(features_path)
 
-    def scaler_func(group):
-        group["rating"] = scaler.fit_transform(group[["count"]])
-        return group
+    # track codes, i.e., rows of the feature table, of all events in the sample;
+    # checked before anything is written, so that an aborted run leaves no
+    # partial outputs
+    track_codes = feature_table.index.get_indexer(df_scaled["track_id"].astype(object))
+    if (track_codes < 0).any():
+        missing = df_scaled["track_id"][track_codes < 0].unique()
+        logger.critical(
+            f"{len(missing)} tracks have no features, e.g. {list(missing[:5])}. Aborting"
+        )
+        return os.EX_DATAERR
 
-    df_scaled = (
-        sample_playcounts.groupby("user_id", sort=False)[
-            ["user_id", "track_id", "count"]
-        ]
-        .apply(scaler_func)
-        .reset_index(drop=True)
-    )
+    logger.info(f"Writing sample to {sample_out}")
+    df.to_csv(sample_out, index=False)
 
     logger.info(f"Writing scaled data to {scaled_out}")
     df_scaled.to_csv(scaled_out, index=False)
 
-    logging.info(f"Reading feature-file {features_path} into memory")
-    feature_index: dict[str, dict] = dict()
-    with open(features_path, "r", newline="") as fd:
-        features_header = next(fd).strip().split(",")
-        reader = csv.DictReader(fd, fieldnames=features_header)
-        for record in reader:
-            feature_index[record["compound"]] = record
-
     logging.info("Writing feature histories for users")
-    writecounter = 0
-    for user, group in sample_playcounts.groupby("user_id"):
-        user_records = []
-        for row in group.itertuples():
-            user_records.append(feature_index[row.track_id])
+    # one gather of all histories, ordered by user and then by position in the
+    # user's playcounts
+    order = np.argsort(df_scaled["user_id"].to_numpy(), kind="stable")
+    users = df_scaled["user_id"].to_numpy()[order]
+    track_codes = track_codes[order]
+
+    if packed_out is not None:
+        histories = feature_table.take(track_codes).reset_index(drop=True)
+        histories.insert(0, "user_id", users)
+        logger.info(f"Writing feature histories of {len(df)} users to {packed_out}")
+        if packed_out.suffix == ".parquet":
+            histories.to_parquet(packed_out, index=False)
+        else:
+            histories.to_csv(packed_out, index=False)
+        return os.EX_OK
+
+    # the rows of tracks in the sample are formatted once, however many users
+    # listened to them
+    used, track_codes = np.unique(track_codes, return_inverse=True)
+    header, lines = format_rows(feature_table.iloc[used])
+    histories = lines[track_codes]
 
-        with open(tmpdir / (str(user) + ".features.csv"), "w") as fout:
-            writer = csv.DictWriter(fout, fieldnames=features_header)
-            writer.writeheader()
-            writer.writerows(user_records)
-            writecounter += 1
+    bounds = np.flatnonzero(np.diff(users)) + 1
+    writecounter = 0
+    for start, end in zip(np.r_[0, bounds], np.r_[bounds, len(users)]):
+        with open(tmpdir / (str(users[start]) + ".features.csv"), "w") as fout:
+            fout.write(header)
+            fout.write("".join(histories[start:end]))
+        writecounter += 1
 
     logger.info(f"Wrote {writecounter} user-feature-files")
 
@@ -113,6 +293,27 @@ if __name__ == "__main__":
     parser.add_argument("--tmpdir", type=pathlib.Path)
     parser.add_argument("--scaled-out", type=pathlib.Path)
     parser.add_argument("--features", type=pathlib.Path)
+    parser.add_argument(
+        "--packed-features-out",
+        type=pathlib.Path,
+        default=None,
+        help="Write all feature histories to this file, with a user_id column, "
+        "instead of one file per user to --tmpdir; Parquet if it ends in .parquet",
+    )
+    parser.add_argument(
+        "--playcounts",
+        type=pathlib.Path,
+        default=None,
+        help="Consolidated Parquet file of the playcounts of the sampled users, read "
+        "instead of the playcount-files in --tmpdir; built from the sample's files if "
+        "it doesn't exist or lacks users of the sample (needs pyarrow)",
+    )
+    parser.add_argument(
+        "--io-threads",
+        type=int,
+        default=None,
+        help="Threads that read playcount-files concurrently",
+    )
     args = parser.parse_args()
 
     sys.exit(
@@ -123,5 +324,8 @@ if __name__ == "__main__":
             args.tmpdir,
             args.scaled_out,
             args.features,
+            args.packed_features_out,
+            args.playcounts,
+            args.io_threads,
         )
     )
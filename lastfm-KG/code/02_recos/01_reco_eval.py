@@ -1,16 +1,24 @@
+import hashlib
 import logging
 import os
 import pathlib
 import sys
 from argparse import ArgumentParser
 from collections import defaultdict
-from typing import List
+from contextlib import ExitStack
+from functools import partial
+from itertools import chain
+from multiprocessing import get_context
+from tempfile import TemporaryDirectory
+from typing import Callable, List, Tuple
 
 import numpy as np
 import pandas as pd
 from jinja2 import Environment, FileSystemLoader
+from scipy.sparse import csr_matrix
 from surprise import (
     NMF,
+    AlgoBase,
     BaselineOnly,
     Dataset,
     KNNBaseline,
@@ -19,17 +27,268 @@ from surprise import (
     KNNWithZScore,
     Prediction,
     Reader,
+    Trainset,
 )
 from surprise.model_selection import KFold
+from surprise.prediction_algorithms.knns import SymmetricAlgo
+
+
+# Cells of the blocks of rows in which similarity matrices are computed
+SIMILARITY_BLOCK_CELLS = 1 << 22
+
+# The algorithms that are evaluated, in the order of the table: name, title and a
+# factory for an unfitted instance
+ALGORITHMS: List[Tuple[str, str, Callable[[], AlgoBase]]] = [
+    ("NMF", "NMF", NMF),
+    ("BaselineOnly", "Mean Baseline Estimate", BaselineOnly),
+    (
+        "KNNBasic",
+        "UserItemkNN",
+        partial(KNNBasic, n=40, sim_options={"name": "cosine"}),
+    ),
+    (
+        "KNNBaseline",
+        "UserItemkNNBaseline",
+        partial(KNNBaseline, n=40, sim_options={"name": "cosine"}),
+    ),
+    (
+        "KNNWithMeans",
+        "UserItemkNNAvg",
+        partial(KNNWithMeans, n=40, sim_options={"name": "cosine"}),
+    ),
+    (
+        "KNNWithZScore",
+        "UserItemkNNZscore",
+        partial(KNNWithZScore, n=40, sim_options={"name": "cosine"}),
+    ),
+]
+
+
+def init_worker(
+    fold_splits: List[Tuple[Trainset, list]],
+    rng_states: list | None,
+    sim_dir: pathlib.Path | None = None,
+):
+    # Workers inherit the folds when they're forked, instead of with every task
+    global folds, random_states, similarity_dir, similarity_cache
+    folds = fold_splits
+    random_states = rng_states
+    similarity_dir = sim_dir
+    similarity_cache = dict()
+
+
+def similarity_key(algo: AlgoBase) -> tuple | None:
+    """The options that an algorithm's similarity matrix depends on.
+
+    None if the algorithm doesn't use one, or if its matrix can't be shared: the
+    pearson_baseline similarity depends on the algorithm's own baselines.
+    """
+    if not isinstance(algo, SymmetricAlgo):
+        return None
+
+    name = algo.sim_options.get("name", "msd").lower()
+    if name == "pearson_baseline":
+        return None
+
+    return name, algo.sim_options["user_based"], algo.sim_options.get("min_support", 1)
+
+
+def rating_arrays(train: Trainset) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Inner user IDs, inner item IDs and ratings of a trainset, ordered by user."""
+    lengths = [len(train.ur[u]) for u in range(train.n_users)]
+    items, values = (
+        np.array(
+            list(chain.from_iterable(map(train.ur.__getitem__, range(train.n_users))))
+        )
+        .reshape(-1, 2)
+        .T
+    )
+    users = np.repeat(np.arange(train.n_users), lengths)
+
+    return users, items.astype(np.int64), values
+
+
+def cosine_similarities(
+    train: Trainset, user_based: bool, min_support: int
+) -> np.ndarray:
+    """The cosine similarity matrix of surprise, from sparse matrix products.
+
+    As in surprise.similarities.cosine, the similarity of x and x' only takes the y
+    that both rated into account, in the norms as well; it's 0 if fewer than
+    min_support y are in common. Ratings must be positive, so that the four products
+    share the sparsity pattern of x and x' having a y in common: a zero rating
+    would drop entries from some of them. They are computed for blocks of rows, and
+    only the similarities in the pattern are written to the otherwise zero matrix.
+    """
+    users, items, values = rating_arrays(train)
+    if not (values > 0).all():
+        raise ValueError("Sparse cosine similarities need positive ratings")
+    if user_based:
+        x, y, n_x, n_y = users, items, train.n_users, train.n_items
+    else:
+        x, y, n_x, n_y = items, users, train.n_items, train.n_users
+
+    def matrix(data: np.ndarray) -> csr_matrix:
+        return csr_matrix((data, (x, y)), (n_x, n_y))
+
+    rated = matrix(np.ones_like(values))
+    ratings = matrix(values)
+    squares = matrix(values**2)
+    rated_t, ratings_t, squares_t = (m.T.tocsr() for m in (rated, ratings, squares))
+
+    sim = np.zeros((n_x, n_x), dtype=np.float64)
+    block = max(1, SIMILARITY_BLOCK_CELLS // max(n_x, 1))
+    for start in range(0, n_x, block):
+        rows = slice(start, min(start + block, n_x))
+        # the entries of a sparse product are ordered by the structure of its
+        # factors alone, so the data of the four products line up
+        freq = rated[rows] @ rated_t
+        prods = (ratings[rows] @ ratings_t).data
+        sqi = (squares[rows] @ rated_t).data
+        sqj = (rated[rows] @ squares_t).data
+
+        values = np.where(freq.data >= min_support, prods / np.sqrt(sqi * sqj), 0)
+        row_ids = np.repeat(np.arange(start, rows.stop), np.diff(freq.indptr))
+        sim[row_ids, freq.indices] = values
+    np.fill_diagonal(sim, 1)
+
+    return sim
+
+
+def trainset_digest(train: Trainset) -> str:
+    """Identifies the ratings of a trainset, to name persisted similarity matrices."""
+    digest = hashlib.sha1()
+    digest.update(
+        "\0".join(map(str, map(train.to_raw_uid, range(train.n_users)))).encode()
+    )
+    digest.update(
+        "\0".join(map(str, map(train.to_raw_iid, range(train.n_items)))).encode()
+    )
+    for array in rating_arrays(train):
+        digest.update(array.tobytes())
+
+    return digest.hexdigest()
+
+
+def shared_similarities(fold: int, algo: AlgoBase) -> np.ndarray:
+    """The similarity matrix of an algorithm fitted on a fold.
+
+    Computed once per fold and similarity options, however many algorithms use it;
+    only the last matrix is kept, so that a worker holds at most one. With a
+    similarity dir, matrices are persisted there and memory-mapped when found.
+    """
+    logger = logging.getLogger(__name__)
+
+    key = (fold, *similarity_key(algo))
+    if key in similarity_cache:
+        return similarity_cache[key]
+    similarity_cache.clear()
+
+    name, user_based, min_support = key[1:]
+    path = None
+    if similarity_dir is not None:
+        path = similarity_dir / (
+            f"{trainset_digest(algo.trainset)}.{name}."
+            f"{'user' if user_based else 'item'}.{min_support}.npy"
+        )
+
+    if path is not None and path.exists():
+        logger.info(f"Reading {name} similarities of fold {fold} from {path}")
+        sim = np.load(path, mmap_mode="r")
+    else:
+        logger.info(f"Computing {name} similarities of fold {fold}")
+        # zero or negative ratings are left to surprise's own computation
+        if name == "cosine" and all(r > 0 for _, _, r in algo.trainset.all_ratings()):
+            sim = cosine_similarities(algo.trainset, user_based, min_support)
+        else:
+            sim = AlgoBase.compute_similarities(algo)
+
+        if path is not None:
+            tmp_path = path.with_name(path.name + ".tmp.npy")
+            np.save(tmp_path, sim)
+            os.replace(tmp_path, path)
+
+    similarity_cache[key] = sim
+    return sim
+
+
+def persist_similarities(task: Tuple[int, int]) -> None:
+    """Computes the similarity matrix of an algorithm on a fold into the similarity dir.
+
+    The matrix isn't kept, so that persisting them one after the other holds at most
+    one in memory.
+    """
+    fold, algo = task
+    _, _, factory = ALGORITHMS[algo]
+    model = factory()
+    # sets the trainset and the x/y orientation, without fitting the model itself
+    SymmetricAlgo.fit(model, folds[fold][0])
+    shared_similarities(fold, model)
+    # evaluate() then memory-maps the file, rather than using this private copy
+    similarity_cache.clear()
+
+
+def evaluate(task: Tuple[int, int]) -> float:
+    """MAE of an algorithm, fitted on the trainset of a fold, on its testset."""
+    fold, algo = task
+    train, test = folds[fold]
+
+    if random_states is not None:
+        np.random.set_state(random_states[fold])
+
+    _, _, factory = ALGORITHMS[algo]
+    model = factory()
+    if similarity_key(model) is not None:
+        model.compute_similarities = partial(shared_similarities, fold, model)
+    preds: List[Prediction] = model.fit(train).test(test)
+
+    return np.mean([abs(p.r_ui - p.est) for p in preds])
+
+
+def similarity_tasks(n_folds: int) -> List[Tuple[int, int]]:
+    """A (fold, algorithm) for each similarity matrix that the algorithms share."""
+    algos = dict()
+    for algo, (_, _, factory) in enumerate(ALGORITHMS):
+        key = similarity_key(factory())
+        if key is not None:
+            algos.setdefault(key, algo)
+
+    return [(fold, algo) for fold in range(n_folds) for algo in algos.values()]
+
+
+def serial_random_states(folds: List[Tuple[Trainset, list]]) -> list:
+    """The states of numpy's global RNG that each fold starts from in a serial run.
+
+    NMF initializes its factors from the global RNG, with one uniform draw for each
+    factor of every user and item; no other algorithm uses it. Replaying the draws
+    lets workers fit each fold's NMF from the state it would have had in a serial run,
+    whichever tasks they ran before. Both paths start each fold from these states, so
+    a serial and a parallel run from the same seed give the same MAEs; unseeded runs
+    differ from each other either way.
+    """
+    n_factors = NMF().n_factors
+    states = []
+    for train, _ in folds:
+        states.append(np.random.get_state())
+        np.random.random_sample((train.n_users + train.n_items) * n_factors)
+
+    return states
 
 
 def run(
     train_path: pathlib.Path,
     sample_size: int = 0,
     table_path: None | pathlib.Path = None,
+    jobs: int = 1,
+    similarity_dir: pathlib.Path | None = None,
+    seed: int | None = None,
 ) -> int:
     logger = logging.getLogger(__name__)
 
+    if seed is not None:
+        # the global RNG drives both the downsampling and NMF's initialization
+        np.random.seed(seed)
+
     logger.info(f"Reading {train_path}")
     df_train = pd.read_csv(train_path)
 
@@ -49,64 +308,64 @@ def run(
 
     splits = KFold(n_splits=5)
 
-    errs = defaultdict(list)
+    # each fold's trainset and testset is built once, and shared by all algorithms
+    folds = list(splits.split(data_train))
+    tasks = [
+        (fold, algo) for fold in range(len(folds)) for algo in range(len(ALGORITHMS))
+    ]
 
-    for i, (train, test) in enumerate(splits.split(data_train)):
-        print("---------------")
-        print(f" Fold {i}    NMF")
-        print("---------------")
-        preds: List[Prediction] = NMF().fit(train).test(test)
-        mae = np.mean([abs(p.r_ui - p.est) for p in preds])
-        print(f"MAE: {mae}")
-        errs["NMF"].append(mae)
-        print("--------------------------")
+    errs = defaultdict(list)
 
-        print("----------------------------------")
-        print(f" Fold {i}    Mean Baseline Estimate")
-        print("----------------------------------")
-        preds = BaselineOnly().fit(train).test(test)
-        mae = np.mean([abs(p.r_ui - p.est) for p in preds])
+    def report(fold: int, algo: int, mae: float):
+        name, title, _ = ALGORITHMS[algo]
+        heading = f" Fold {fold}    {title}"
+        print("-" * (len(heading) + 1))
+        print(heading)
+        print("-" * (len(heading) + 1))
         print(f"MAE: {mae}")
-        errs["BaselineOnly"].append(mae)
+        errs[name].append(mae)
         print("--------------------------")
 
-        print("-----------------------")
-        print(f" Fold {i}    UserItemkNN")
-        print("-----------------------")
-        preds = KNNBasic(n=40, sim_options={"name": "cosine"}).fit(train).test(test)
-        mae = np.mean([abs(p.r_ui - p.est) for p in preds])
-        print(f"MAE: {mae}")
-        errs["KNNBasic"].append(mae)
-        print("--------------------------")
+    if similarity_dir is not None:
+        similarity_dir.mkdir(parents=True, exist_ok=True)
 
-        print("------------------------------")
-        print(f" Fold {i}    UserItemkNNBaseline")
-        print("------------------------------")
-        preds = KNNBaseline(n=40, sim_options={"name": "cosine"}).fit(train).test(test)
-        mae = np.mean([abs(p.r_ui - p.est) for p in preds])
-        print(f"MAE: {mae}")
-        errs["KNNBaseline"].append(mae)
-        print("--------------------------")
+    random_states = serial_random_states(folds)
 
-        print("--------------------------")
-        print(f" Fold {i}    UserItemkNNAvg")
-        print("--------------------------")
-        preds = KNNWithMeans(n=40, sim_options={"name": "cosine"}).fit(train).test(test)
-        mae = np.mean([abs(p.r_ui - p.est) for p in preds])
-        print(f"MAE: {mae}")
-        errs["KNNWithMeans"].append(mae)
-        print("--------------------------")
-
-        print("-----------------------------")
-        print(f" Fold {i}    UserItemkNNZscore")
-        print("-----------------------------")
-        preds = (
-            KNNWithZScore(n=40, sim_options={"name": "cosine"}).fit(train).test(test)
+    if jobs <= 1:
+        # the algorithms of a fold are evaluated one after the other, so the ones
+        # that share a similarity matrix find it in the cache
+        init_worker(folds, random_states, similarity_dir)
+        for fold, algo in tasks:
+            report(fold, algo, evaluate((fold, algo)))
+    else:
+        logger.info(
+            f"Evaluating {len(ALGORITHMS)} algorithms on {len(folds)} folds with "
+            f"{jobs} processes"
         )
-        mae = np.mean([abs(p.r_ui - p.est) for p in preds])
-        print(f"MAE: {mae}")
-        errs["KNNWithZScore"].append(mae)
-        print("--------------------------")
+        with ExitStack() as stack:
+            # the similarity matrices are computed once, one after the other, into
+            # files that the workers then memory-map read-only: all of them read
+            # the same pages instead of holding a copy each, and no more than one
+            # matrix is ever in memory
+            shared_dir = similarity_dir or pathlib.Path(
+                stack.enter_context(TemporaryDirectory())
+            )
+            init_worker(folds, random_states, shared_dir)
+            for task in similarity_tasks(len(folds)):
+                persist_similarities(task)
+
+            # the workers are forked once the folds are built, so that they share
+            # them instead of receiving a copy with every task. imap returns the
+            # MAEs in the order of the tasks, whichever worker finishes first
+            p = stack.enter_context(
+                get_context("fork").Pool(
+                    jobs,
+                    initializer=init_worker,
+                    initargs=(folds, random_states, shared_dir),
+                )
+            )
+            for (fold, algo), mae in zip(tasks, p.imap(evaluate, tasks)):
+                report(fold, algo, mae)
 
     mmeans = {k: np.mean(m) for k, m in errs.items()}
     minim = min(mmeans.items(), key=lambda x: x[1])
@@ -149,6 +408,35 @@ if __name__ == "__main__":
         default=None,
         help="If provided, render table-template to this file.",
     )
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        default=1,
+        help="Evaluate the algorithms on the folds with this many processes",
+    )
+    parser.add_argument(
+        "--similarity-dir",
+        type=pathlib.Path,
+        default=None,
+        help="Persist the similarity matrices of the folds to this dir, and reuse "
+        "them from it",
+    )
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=None,
+        help="Seed numpy's RNG, for the downsampling and NMF; runs with the same "
+        "seed give the same MAEs, whatever --jobs is",
+    )
     args = parser.parse_args()
 
-    sys.exit(run(args.trainfile, args.sample, args.write_table))
+    sys.exit(
+        run(
+            args.trainfile,
+            args.sample,
+            args.write_table,
+            args.jobs,
+            args.similarity_dir,
+            args.seed,
+        )
+    )
@@ -6,7 +6,7 @@ import pathlib
 import sys
 from argparse import ArgumentParser
 from collections import defaultdict
-from typing import DefaultDict, List, Tuple, Type
+from typing import DefaultDict, Iterator, List, Tuple, Type
 
 import pandas as pd
 import surprise
@@ -26,12 +26,50 @@ def get_top_n(
     return top
 
 
+def stream_top_n(
+    algo: surprise.AlgoBase, trainset: surprise.Trainset, n: int = 10
+) -> Iterator[Tuple[str, List[Tuple[str, float]]]]:
+    """Top-n of each user among the items they haven't rated, one user at a time.
+
+    The same as get_top_n on the predictions for build_anti_testset(), without
+    materializing them: a user's candidates are scored lazily, and heapq.nlargest
+    only keeps a heap of n of them. Yields users in the order of the anti-testset;
+    users without candidates are skipped, as they have no predictions.
+    """
+    raw_iids = [trainset.to_raw_iid(i) for i in trainset.all_items()]
+
+    for u in trainset.all_users():
+        uid = trainset.to_raw_uid(u)
+        rated = {j for (j, _) in trainset.ur[u]}
+        candidates = (
+            (raw_iids[i], algo.predict(uid, raw_iids[i]).est)
+            for i in trainset.all_items()
+            if i not in rated
+        )
+
+        top = heapq.nlargest(n, candidates, key=lambda x: x[1])
+        if top:
+            yield uid, top
+
+
+def write_recos(save_dir: pathlib.Path, user: str, recos: List[Tuple[str, float]]):
+    with open(save_dir / (str(user) + ".csv"), "wt") as f:
+        writer = csv.DictWriter(f, fieldnames=["user_id", "track_id", "score"])
+        writer.writeheader()
+
+        data = []
+        for track, score in recos:
+            data.append({"user_id": user, "track_id": track, "score": score})
+        writer.writerows(data)
+
+
 def run(
     algo: Type[surprise.AlgoBase],
     train_path: pathlib.Path,
     save_dir: pathlib.Path,
     sample_size: int = 0,
     top_n: int = 100,
+    stream: bool = False,
 ) -> int:
     logger = logging.getLogger(__name__)
 
@@ -53,6 +91,20 @@ def run(
     )
 
     data_train = data_train.build_full_trainset()
+
+    if stream:
+        algo = algo().fit(data_train)
+
+        logger.info(f"Writing top {top_n} recos of each user to {save_dir}")
+        n_users = 0
+        for user, recos in stream_top_n(algo, data_train, top_n):
+            write_recos(save_dir, user, recos)
+            n_users += 1
+            if n_users % 100 == 0:
+                logger.info(f"Wrote recos of {n_users}/{data_train.n_users} users")
+
+        return os.EX_OK
+
     data_test = data_train.build_anti_testset()
 
     predictions = algo().fit(data_train).test(data_test)
@@ -62,14 +114,7 @@ def run(
 
     logger.info(f"Writing individual recos to {save_dir}")
     for user, recos in top_recos.items():
-        with open(save_dir / (str(user) + ".csv"), "wt") as f:
-            writer = csv.DictWriter(f, fieldnames=["user_id", "track_id", "score"])
-            writer.writeheader()
-
-            data = []
-            for track, score in recos:
-                data.append({"user_id": user, "track_id": track, "score": score})
-            writer.writerows(data)
+        write_recos(save_dir, user, recos)
 
     return os.EX_OK
 
@@ -91,6 +136,12 @@ if __name__ == "__main__":
         default=100,
         help="Extract top N recommendations, sorted by score",
     )
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="Score one user at a time and write their recos right away, instead of "
+        "predicting all unrated (user, track) pairs at once",
+    )
     args = parser.parse_args()
 
     algo = getattr(surprise, args.algo, None)
@@ -102,4 +153,13 @@ if __name__ == "__main__":
         level=logging.DEBUG,
     )
 
-    sys.exit(run(algo, args.trainfile, args.save_dir, args.sample, args.top_n))
+    sys.exit(
+        run(
+            algo,
+            args.trainfile,
+            args.save_dir,
+            args.sample,
+            args.top_n,
+            args.stream,
+        )
+    )
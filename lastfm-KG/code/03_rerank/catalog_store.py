@@ -0,0 +1,132 @@
+import hashlib
+import logging
+import os
+import pathlib
+import sys
+from argparse import ArgumentParser
+
+import rdflib
+
+from kgmetrics.catalog_store import (
+    STORE_FILES,
+    CatalogStore,
+    compile_catalog,
+    is_catalog_store,
+    save_catalog,
+)
+from kgmetrics.line_loader import parse_triples
+
+# Checksum of the Turtle file a store was compiled from, to tell when it's stale
+SOURCE_CHECKSUM_FILE = "source.sha256"
+
+# Size and mtime of that file when its checksum was last taken; while they are the
+# same, the file isn't hashed again
+SOURCE_STAT_FILE = "source.stat"
+
+
+def catalog_checksum(path: pathlib.Path) -> str:
+    """SHA-256 of a catalog file, or of the files of a compiled store."""
+    digest = hashlib.sha256()
+    for file in [path / f for f in STORE_FILES] if path.is_dir() else [path]:
+        with open(file, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                digest.update(block)
+    return digest.hexdigest()
+
+
+def source_stat(path: pathlib.Path) -> str:
+    stat = path.stat()
+    return f"{stat.st_size} {stat.st_mtime_ns}"
+
+
+def compile_catalog_file(
+    catalog_kg_file: pathlib.Path, store_dir: pathlib.Path, nproc: int = 1
+):
+    """Compiles a catalog file, parsed by line_loader if it's in its dialect."""
+    logger = logging.getLogger(__name__)
+
+    triples = parse_triples(catalog_kg_file, nproc)
+    if triples is not None:
+        save_catalog(*triples, store_dir)
+        return
+
+    logger.info(f"Parsing {catalog_kg_file} with rdflib")
+    catalog_kg = rdflib.Graph()
+    catalog_kg.parse(catalog_kg_file)
+    compile_catalog(catalog_kg, store_dir)
+
+
+def open_catalog(
+    catalog_kg_file: pathlib.Path, store_dir: pathlib.Path, nproc: int = 1
+) -> tuple[CatalogStore, pathlib.Path, str]:
+    """The catalog as a store, compiling it first if it's a Turtle file.
+
+    A Turtle catalog is compiled into store_dir, unless store_dir already holds a
+    store compiled from the same file. The file is only hashed to tell that if its
+    size or mtime changed since the store was compiled. Returns the store, its
+    directory and the checksum of the catalog as given.
+    """
+    logger = logging.getLogger(__name__)
+
+    if is_catalog_store(catalog_kg_file):
+        store = CatalogStore(catalog_kg_file)
+        return store, catalog_kg_file, catalog_checksum(catalog_kg_file)
+
+    checksum_file = store_dir / SOURCE_CHECKSUM_FILE
+    stat_file = store_dir / SOURCE_STAT_FILE
+    stat = source_stat(catalog_kg_file)
+
+    checksum = None
+    if is_catalog_store(store_dir) and checksum_file.is_file():
+        compiled_from = checksum_file.read_text().strip()
+        if stat_file.is_file() and stat_file.read_text().strip() == stat:
+            checksum = compiled_from
+        else:
+            checksum = catalog_checksum(catalog_kg_file)
+
+        if checksum == compiled_from:
+            logger.info(f"Reusing compiled catalog {store_dir}")
+            stat_file.write_text(stat + "\n")
+            return CatalogStore(store_dir), store_dir, checksum
+
+    if checksum is None:
+        checksum = catalog_checksum(catalog_kg_file)
+
+    logger.info(f"Reading catalog KG from {catalog_kg_file}")
+    # an interrupted compilation must not pass for one of this file
+    checksum_file.unlink(missing_ok=True)
+    stat_file.unlink(missing_ok=True)
+    compile_catalog_file(catalog_kg_file, store_dir, nproc)
+    checksum_file.write_text(checksum + "\n")
+    stat_file.write_text(stat + "\n")
+
+    return CatalogStore(store_dir), store_dir, checksum
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        format="%(asctime)-15s %(name)-15s %(process)-3d %(levelname)-15s %(message)s",
+        level=logging.INFO,
+    )
+
+    parser = ArgumentParser()
+    parser.add_argument(
+        "--catalog-kg", type=pathlib.Path, help="Path to the catalog KG (*.ttl)"
+    )
+    parser.add_argument(
+        "--store-dir", type=pathlib.Path, help="Directory to write the store to"
+    )
+
+    parser.add_argument(
+        "--nproc",
+        type=int,
+        default=1,
+        help="Number of processes parsing the catalog, if it's in the "
+        "one-triple-per-line dialect written by kgbuilder.py",
+    )
+
+    args = parser.parse_args()
+
+    compile_catalog_file(args.catalog_kg, args.store_dir, args.nproc)
+
+    sys.exit(os.EX_OK)
@@ -0,0 +1,114 @@
+import json
+import logging
+import os
+import pathlib
+from contextlib import contextmanager
+
+# Completion manifest of an output dir: one JSON record per line, appended once an
+# output has been renamed into place,
+#
+#   {"user": "42", "tracks": ["1203", ...], "file": "42/1203.ttl", "size": 5120}
+#
+# where tracks is null if the file holds all of the user's outputs. Records are
+# appended with a single write, so concurrent workers can share the manifest.
+MANIFEST_FILE = ".manifest.jsonl"
+
+TMP_SUFFIX = ".tmp"
+
+
+@contextmanager
+def atomic_write(path: pathlib.Path):
+    """Yields a temporary path to write to, renamed to `path` once done.
+
+    A crash leaves either the old file or the new one, never a truncated one; the
+    temporary file is removed on errors, or by Manifest on resuming after a crash.
+    """
+    tmp_file = path.with_name(path.name + TMP_SUFFIX)
+    try:
+        yield tmp_file
+        os.replace(tmp_file, path)
+    finally:
+        tmp_file.unlink(missing_ok=True)
+
+
+class Manifest:
+    """Which users and candidates of an output dir are done.
+
+    Without `resume`, the manifest is started over. With it, the records of a
+    previous run are read back and validated: records whose file is missing or
+    doesn't have the recorded size are dropped, so that their work is redone, and
+    temporary files left by a crash are removed. The manifest is then rewritten with
+    the valid records only.
+    """
+
+    def __init__(self, out_dir: pathlib.Path, resume: bool = False):
+        logger = logging.getLogger(__name__)
+
+        self.out_dir = out_dir
+        self.path = out_dir / MANIFEST_FILE
+        self._users: set[str] = set()
+        self._tracks: dict[str, dict[str, pathlib.Path]] = dict()
+
+        if not resume or not self.path.exists():
+            out_dir.mkdir(parents=True, exist_ok=True)
+            self.path.write_text("")
+            return
+
+        for tmp_file in out_dir.rglob(f"*{TMP_SUFFIX}"):
+            logger.info(f"Removing partial output {tmp_file}")
+            tmp_file.unlink()
+
+        valid: list[str] = []
+        invalid = 0
+        with open(self.path) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:  # the last line of a crashed run
+                    invalid += 1
+                    continue
+
+                output = out_dir / record["file"]
+                if not output.exists() or output.stat().st_size != record["size"]:
+                    invalid += 1
+                    continue
+
+                valid.append(line if line.endswith("\n") else line + "\n")
+                if record["tracks"] is None:
+                    self._users.add(record["user"])
+                else:
+                    tracks = self._tracks.setdefault(record["user"], dict())
+                    tracks.update(dict.fromkeys(record["tracks"], output))
+
+        with atomic_write(self.path) as tmp_file:
+            tmp_file.write_text("".join(valid))
+
+        logger.info(
+            f"Resuming from {self.path}: {len(self._users)} users done, "
+            f"{len(valid)} valid and {invalid} invalid records"
+        )
+
+    def is_done(self, user: str) -> bool:
+        return user in self._users
+
+    def done_tracks(self, user: str) -> dict[str, pathlib.Path]:
+        """The user's candidates that are done, and the files they are in."""
+        return self._tracks.get(user, dict())
+
+    def record(
+        self, user: str, output: pathlib.Path, track_ids: list[str] | None = None
+    ):
+        line = json.dumps(
+            {
+                "user": user,
+                "tracks": track_ids,
+                "file": str(output.relative_to(self.out_dir)),
+                "size": output.stat().st_size,
+            }
+        )
+
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT)
+        try:
+            os.write(fd, (line + "\n").encode("utf-8"))
+        finally:
+            os.close(fd)
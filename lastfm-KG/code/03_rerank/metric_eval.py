@@ -4,53 +4,32 @@ import os
 import pathlib
 import sys
 from argparse import ArgumentParser
+from collections import Counter
 from multiprocessing import Pool
 from typing import NamedTuple
 
-import networkx as nx
 import numpy as np
-from concentrationMetrics import Index
-from rdflib.extras.external_graph_libs import rdflib_to_networkx_digraph
 from rdflib.graph import Graph
 
+from checkpoint import Manifest, atomic_write
+from kgmetrics.approximate_centrality import parse_metric
+from kgmetrics.concentration import split_concentration
+from kgmetrics.metrics import IncrementalMetrics, uses_sampling
+from subgraph_deltas import DELTA_SUFFIX, UserDeltas, is_delta_file
 
-def hhi(lst):
-    return Index().hhi(np.array(lst))
 
-
-def computeMetric(kg: Graph, metric: str):
-
-    nx_kg = rdflib_to_networkx_digraph(kg)
-
-    if "density" == metric:
-        return nx.density(nx_kg)
-    if "numedges" == metric:
-        return nx_kg.number_of_edges()
-    if "numnodes" == metric:
-        return nx_kg.number_of_nodes()
-    if "avg_degree" == metric:
-        return nx_kg.number_of_edges() / nx_kg.number_of_nodes()
-
-    if "betweenness" == metric:
-        computed = nx.betweenness_centrality(nx_kg)
-        return hhi(list(computed.values()))
-    if "closeness" == metric:
-        computed = nx.closeness_centrality(nx_kg)
-        return hhi(list(computed.values()))
-    if "pagerank" == metric:
-        computed = nx.pagerank(nx_kg)
-        return hhi(list(computed.values()))
-    if "in_degree" == metric:
-        computed = nx.in_degree_centrality(nx_kg)
-        return hhi(list(computed.values()))
-    if "out_degree" == metric:
-        computed = nx.out_degree_centrality(nx_kg)
-        return hhi(list(computed.values()))
-    if "degree" == metric:
-        computed = nx.degree_centrality(nx_kg)
-        return hhi(list(computed.values()))
-
-    raise ValueError("Unsupported metric!")
+METRICS = [
+    "density",
+    "numedges",
+    "numnodes",
+    "avg_degree",
+    "betweenness",
+    "closeness",
+    "pagerank",
+    "in_degree",
+    "out_degree",
+    "degree",
+]
 
 
 class MetricLine(NamedTuple):
@@ -58,60 +37,211 @@ class MetricLine(NamedTuple):
     track_id: str
     metric_name: str
     metric_val: float
+    # standard error of a metric approximated from sampled pivots, None if exact
+    metric_stderr: float | None = None
+
+
+def write_metric_lines(
+    path: pathlib.Path, data: list[MetricLine], with_stderr: bool = False
+) -> pathlib.Path:
+    """Writes metric lines as CSV; the metric_stderr column only if with_stderr."""
+    fields = list(MetricLine._fields)
+    if not with_stderr:
+        fields.remove("metric_stderr")
+
+    with atomic_write(path) as tmp_file:
+        with open(tmp_file, "w") as f:
+            writer = csv.DictWriter(f, fieldnames=fields, extrasaction="ignore")
+            writer.writeheader()
+            writer.writerows(map(lambda x: x._asdict(), data))
+    return path
+
+
+def read_metric_lines(path: pathlib.Path) -> list[MetricLine]:
+    def parse(record: dict[str, str]) -> MetricLine:
+        stderr = record.pop("metric_stderr", "")
+        return MetricLine(
+            **{**record, "metric_val": float(record["metric_val"])},
+            metric_stderr=float(stderr) if stderr else None,
+        )
+
+    with open(path) as f:
+        return [parse(record) for record in csv.DictReader(f)]
+
+
+def write_results(
+    user_out_dir: pathlib.Path, data: list[MetricLine], with_stderr: bool = False
+) -> pathlib.Path:
+    return write_metric_lines(user_out_dir / "results.csv", data, with_stderr)
+
+
+# Metrics that run a BFS from every node, so their cost grows with nodes x edges; all
+# others are about linear in the edges
+QUADRATIC_METRICS = ["betweenness", "closeness"]
+
+# Users costing more than 1/(TASKS_PER_WORKER * nproc) of the total are split into
+# per-candidate tasks of about that cost, so that no single user holds up the pool
+TASKS_PER_WORKER = 4
+
+
+class UserJob(NamedTuple):
+    user: str
+    user_subgraph: pathlib.Path
+    updated_subgraphs: pathlib.Path
+    track_ids: list[str]
+    candidate_cost: float
+
 
+class Task(NamedTuple):
+    job: UserJob
+    part: int
+    track_ids: list[str]
+    metrics: list[str]
 
-def f(
-    user_subgraph: pathlib.Path, updated_subgraphs: pathlib.Path, out_dir: pathlib.Path
-):
-    # This worker is executed separately per user, i.e. one worker only
-    # ever sees one user
 
+def estimate_size(
+    user_subgraph: pathlib.Path, updated_subgraphs: pathlib.Path
+) -> tuple[int, int]:
+    """Nodes and edges of a user's sub-KG, without parsing it.
+
+    Exact for delta files; for Turtle, both are estimated by the number of lines,
+    which is about one per triple in rdflib's output.
+    """
+    if is_delta_file(updated_subgraphs):
+        with np.load(updated_subgraphs) as deltas:
+            base = deltas["base"]
+        return len(np.unique(base[:, [0, 2]])), len(base)
+
+    with open(user_subgraph, "rb") as f:
+        lines = sum(1 for _ in f)
+    return lines, lines
+
+
+def candidate_cost(nodes: int, edges: int, metrics: list[str]) -> float:
+    def is_quadratic(metric: str) -> bool:
+        name, options = parse_metric(split_concentration(metric)[0])
+        return name in QUADRATIC_METRICS and not options
+
+    if any(is_quadratic(m) for m in metrics):
+        return float(nodes + 1) * (edges + 1)
+    return float(edges + 1)
+
+
+def collect_jobs(
+    updated_kg_dir: pathlib.Path, base_subgraph_dir: pathlib.Path, metrics: list[str]
+) -> list[UserJob]:
     logger = logging.getLogger(__name__)
 
-    metrics = [
-        "density",
-        "numedges",
-        "numnodes",
-        "avg_degree",
-        "betweenness",
-        "closeness",
-        "pagerank",
-        "in_degree",
-        "out_degree",
-        "degree",
-    ]
+    jobs = []
+    for user_subgraph in sorted(base_subgraph_dir.glob("*.subkg.ttl")):
+        user = user_subgraph.name.removesuffix(".subkg.ttl")
+
+        # either a delta file or a dir of Turtle files
+        updated = updated_kg_dir / (user + DELTA_SUFFIX)
+        if not updated.exists():
+            updated = updated_kg_dir / user
+        if not updated.exists():
+            logger.error(f"No updated subgraphs for {user}")
+            continue
+
+        if is_delta_file(updated):
+            track_ids = UserDeltas(updated).track_ids
+        else:
+            track_ids = sorted(s.stem for s in updated.glob("*.ttl"))
+
+        nodes, edges = estimate_size(user_subgraph, updated)
+        jobs.append(
+            UserJob(
+                user=user,
+                user_subgraph=user_subgraph,
+                updated_subgraphs=updated,
+                track_ids=track_ids,
+                candidate_cost=candidate_cost(nodes, edges, metrics),
+            )
+        )
+
+    return jobs
+
+
+def schedule(jobs: list[UserJob], nproc: int, metrics: list[str]) -> list[Task]:
+    """Tasks for all jobs, longest first.
+
+    Dispatching the longest tasks first keeps the makespan close to the optimum
+    (LPT scheduling); splitting large users keeps any one task from dominating it.
+    """
+    total = sum(len(j.track_ids) * j.candidate_cost for j in jobs)
+    max_task_cost = total / (TASKS_PER_WORKER * nproc) if nproc > 1 else total
 
-    user = user_subgraph.name.removesuffix(".subkg.ttl")
-    logger.info(f"Processing user {user}")
+    tasks = []
+    for job in jobs:
+        if len(job.track_ids) * job.candidate_cost <= max_task_cost:
+            chunk = len(job.track_ids)
+        else:
+            chunk = max(1, int(max_task_cost // job.candidate_cost))
+
+        for part, i in enumerate(range(0, len(job.track_ids), chunk)):
+            tasks.append(Task(job, part, job.track_ids[i : i + chunk], metrics))
+
+    return sorted(
+        tasks, key=lambda t: len(t.track_ids) * t.job.candidate_cost, reverse=True
+    )
+
+
+# The user a worker last evaluated, reused by its later tasks for the same user:
+# (user, IncrementalMetrics, UserDeltas or None)
+worker_user: tuple = (None, None, None)
+
+
+def f(task: Task) -> tuple[Task, list[MetricLine]]:
+    global worker_user
+
+    logger = logging.getLogger(__name__)
+
+    job = task.job
+    logger.info(
+        f"Processing user {job.user}, part {task.part} ({len(task.track_ids)} tracks)"
+    )
+
+    # The updated subgraphs are the user's subgraph plus a small neighborhood, so
+    # convert the user's subgraph once and only apply each neighborhood on top
+    user, user_metrics, deltas = worker_user
+    if user != job.user:
+        if is_delta_file(job.updated_subgraphs):
+            # the user's subgraph and each neighborhood are decoded from one file
+            deltas = UserDeltas(job.updated_subgraphs)
+            user_metrics = IncrementalMetrics(deltas.base)
+        else:
+            deltas = None
+            base = Graph()
+            base.parse(job.user_subgraph)
+            user_metrics = IncrementalMetrics(base)
+        worker_user = (job.user, user_metrics, deltas)
 
     data: list[MetricLine] = []
 
     # Read the subgraphs that resulted from incorporating each recommendation
-    for subgraph in updated_subgraphs.glob("*.ttl"):
-        track_id = subgraph.stem
+    for track_id in task.track_ids:
+        if deltas is not None:
+            g = deltas.delta(track_id)
+        else:
+            g = Graph().parse(job.updated_subgraphs / f"{track_id}.ttl")
+        user_metrics.apply_delta(g)
 
         # Compute each metric on each subgraph
-        for metric in metrics:
-            g = Graph()
-            g.parse(subgraph)
-            m = computeMetric(g, metric)
+        errors: dict[str, float] = dict()
+        for metric, m in user_metrics.compute_metrics(task.metrics, errors).items():
             line = MetricLine(
-                user_id=user, track_id=track_id, metric_name=metric, metric_val=float(m)
+                user_id=job.user,
+                track_id=track_id,
+                metric_name=metric,
+                metric_val=float(m),
+                metric_stderr=errors.get(metric),
             )
             data.append(line)
 
-    user_out_dir = pathlib.Path(out_dir / user)
-    user_out_dir.mkdir(exist_ok=True)
-
-    logger.info(f"Done for user {user}, writing results to {user_out_dir}")
-    with open(user_out_dir / "results.csv", "w") as f:
-        writer = csv.DictWriter(
-            f, fieldnames=["user_id", "track_id", "metric_name", "metric_val"]
-        )
-        writer.writeheader()
-        writer.writerows(map(lambda x: x._asdict(), data))
+        user_metrics.rollback()
 
-    return user
+    return task, data
 
 
 def run(
@@ -119,22 +249,93 @@ def run(
     base_subgraph_dir: pathlib.Path,
     metrics_out_dir: pathlib.Path,
     nproc: int = 1,
+    metrics: list[str] = METRICS,
+    resume: bool = False,
 ) -> int:
     logger = logging.getLogger(__name__)
 
+    # as Pool(None) would
+    nproc = nproc or os.cpu_count() or 1
+
+    manifest = Manifest(metrics_out_dir, resume)
+
+    # standard errors are written in a column of their own, if there are any
+    with_stderr = uses_sampling(metrics)
+
     logger.info(f"Collecting base subgraphs from {base_subgraph_dir}")
-    subgraphs = list(base_subgraph_dir.glob("*.subkg.ttl"))
-    updated_subgraph_dirs = list(updated_kg_dir.glob("*"))
-    inputs = zip(
-        sorted(subgraphs),
-        sorted(updated_subgraph_dirs),
-        [metrics_out_dir] * len(subgraphs),
-    )
+    jobs = {
+        job.user: job
+        for job in collect_jobs(updated_kg_dir, base_subgraph_dir, metrics)
+        if not manifest.is_done(job.user)
+    }
+
+    # Metrics of the candidates finished by a previous run, by user and track
+    done: dict[str, dict[str, list[MetricLine]]] = {user: dict() for user in jobs}
+    partial_files: dict[str, set[pathlib.Path]] = {user: set() for user in jobs}
+    for user in jobs:
+        for partial_file in set(manifest.done_tracks(user).values()):
+            for line in read_metric_lines(partial_file):
+                done[user].setdefault(line.track_id, []).append(line)
+            partial_files[user].add(partial_file)
+
+    remaining = [
+        job._replace(track_ids=[t for t in job.track_ids if t not in done[job.user]])
+        for job in jobs.values()
+    ]
+    tasks = schedule(remaining, nproc, metrics)
+    logger.info(f"Scheduled {len(tasks)} tasks for {len(jobs)} users")
+
+    def write_user(user: str):
+        user_out_dir = pathlib.Path(metrics_out_dir / user)
+        user_out_dir.mkdir(exist_ok=True)
+
+        logger.info(f"Done for user {user}, writing results to {user_out_dir}")
+        rows = done.pop(user)
+        data = [line for t in jobs[user].track_ids for line in rows.get(t, [])]
+        manifest.record(user, write_results(user_out_dir, data, with_stderr))
+
+        for partial_file in partial_files.pop(user):
+            partial_file.unlink()
+
+    def write_partial(user: str, track_ids: list[str], data: list[MetricLine]):
+        # a user's tracks are disjoint across tasks and runs, so its first one
+        # names the file
+        user_out_dir = pathlib.Path(metrics_out_dir / user)
+        user_out_dir.mkdir(exist_ok=True)
+
+        partial_file = user_out_dir / f"results.{track_ids[0]}.partial.csv"
+        manifest.record(
+            user, write_metric_lines(partial_file, data, with_stderr), track_ids
+        )
+        partial_files[user].add(partial_file)
+
+    remaining_parts = Counter(task.job.user for task in tasks)
+    remaining_parts.update(dict.fromkeys(jobs, 0))
+    completed = []
+
+    for user, n in remaining_parts.items():
+        # no (more) candidates to evaluate, but still a results file
+        if n == 0:
+            write_user(user)
+            completed.append(user)
 
     logger.info(f"Initializing pool with {nproc} workers")
     with Pool(nproc) as p:
-        ps_completed = p.starmap(f, inputs)
-        print(list(ps_completed))
+        for task, data in p.imap_unordered(f, tasks):
+            user = task.job.user
+            for line in data:
+                done[user].setdefault(line.track_id, []).append(line)
+
+            remaining_parts[user] -= 1
+            if remaining_parts[user] == 0:
+                write_user(user)
+                completed.append(user)
+            else:
+                # checkpoint the candidates, in case the run doesn't get to the
+                # end of the user
+                write_partial(user, task.track_ids, data)
+
+    print(completed)
 
     return os.EX_OK
 
@@ -149,7 +350,8 @@ if __name__ == "__main__":
     parser.add_argument(
         "--updated-kg-dir",
         type=pathlib.Path,
-        help="Path to user-kgs that have been updated with recos",
+        help="Path to user-kgs that have been updated with recos, as written by "
+        "update_user_subgraphs.py in either format",
     )
     parser.add_argument(
         "--base-subgraph-dir",
@@ -165,6 +367,21 @@ if __name__ == "__main__":
         help="Number of workers to spawn",
     )
 
+    parser.add_argument(
+        "--metrics",
+        type=lambda s: s.split(","),
+        default=METRICS,
+        help="Comma-separated metric list; betweenness and closeness can be "
+        "approximated from k sampled pivots, e.g. 'betweenness~k=256~seed=42'",
+    )
+
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Skip the users and candidates that a previous run into the same "
+        "--metrics-out-dir finished, as recorded in its manifest",
+    )
+
     args = parser.parse_args()
 
     sys.exit(
@@ -173,5 +390,7 @@ if __name__ == "__main__":
             args.base_subgraph_dir,
             args.metrics_out_dir,
             args.nproc,
+            args.metrics,
+            args.resume,
         )
     )
@@ -0,0 +1,231 @@
+import logging
+import os
+import pathlib
+import sys
+from argparse import ArgumentParser
+from multiprocessing import get_context
+
+import rdflib
+
+from catalog_store import open_catalog
+from kgmetrics.catalog_store import is_catalog_store
+from kgmetrics.metrics import IncrementalMetrics, uses_sampling
+from kgmetrics.overlay_graph import OverlayGraph
+from metric_eval import METRICS, MetricLine, write_results
+from update_user_subgraphs import (
+    DEFAULT_CACHE_SIZE,
+    NeighborhoodCache,
+    read_reco_track_ids,
+    reco_items_of,
+    track_uri,
+)
+
+# update_user_subgraphs.py and metric_eval.py in one pass: each candidate graph (the
+# user's sub-KG plus the neighborhood of a recommended track) only exists in memory,
+# and only the metrics are written.
+
+
+def init_worker(
+    store_dir: pathlib.Path,
+    precomputed: dict[rdflib.URIRef, tuple] | None,
+    cache_size: int,
+    rdir: pathlib.Path,
+    odir: pathlib.Path,
+    kg_dir: pathlib.Path | None,
+    metric_list: list[str],
+):
+    # Workers attach to the compiled catalog instead of receiving a copy of it, and
+    # inherit the precomputed neighborhoods from the parent when forked
+    global neighborhoods, reco_dir, out_dir, debug_kg_dir, metrics
+    neighborhoods = NeighborhoodCache.attach(store_dir, precomputed, cache_size)
+    reco_dir = rdir
+    out_dir = odir
+    debug_kg_dir = kg_dir
+    metrics = metric_list
+
+
+def f(profile: pathlib.Path):
+    logger = logging.getLogger(__name__)
+
+    user = profile.name.removesuffix(".subkg.ttl")
+    user_reco = reco_dir / (user + ".csv")
+
+    if not user_reco.exists():
+        logger.error(f"No recos for {user}")
+        return
+
+    logger.info(f"Processing user {user}")
+    user_kg = rdflib.Graph()
+    user_kg.parse(profile)
+    user_metrics = IncrementalMetrics(user_kg)
+
+    if debug_kg_dir is not None:
+        user_kg_dir = debug_kg_dir / user
+        user_kg_dir.mkdir(exist_ok=True)
+
+    data: list[MetricLine] = []
+    for track_id in read_reco_track_ids(user_reco):
+        neigh_kg = neighborhoods.get(track_uri(track_id))
+
+        if debug_kg_dir is not None:
+            OverlayGraph(user_kg, neigh_kg).serialize(
+                destination=user_kg_dir / f"{track_id}.ttl"
+            )
+
+        user_metrics.apply_delta(neigh_kg)
+        errors: dict[str, float] = dict()
+        for metric, m in user_metrics.compute_metrics(metrics, errors).items():
+            data.append(
+                MetricLine(
+                    user_id=user,
+                    track_id=track_id,
+                    metric_name=metric,
+                    metric_val=float(m),
+                    metric_stderr=errors.get(metric),
+                )
+            )
+        user_metrics.rollback()
+
+    user_out_dir = out_dir / user
+    user_out_dir.mkdir(exist_ok=True)
+
+    logger.info(f"Done for user {user}, writing results to {user_out_dir}")
+    write_results(user_out_dir, data, uses_sampling(metrics))
+    logger.info(f"Neighborhood cache: {neighborhoods.stats()}")
+
+    return user
+
+
+def run(
+    catalog_kg_file: pathlib.Path,
+    user_kg_dir: pathlib.Path,
+    reco_dir: pathlib.Path,
+    metrics_out_dir: pathlib.Path,
+    nproc: int = 1,
+    metrics: list[str] = METRICS,
+    debug_kg_dir: pathlib.Path | None = None,
+    cache_dir: pathlib.Path | None = None,
+    cache_size: int = DEFAULT_CACHE_SIZE,
+    store_dir: pathlib.Path | None = None,
+) -> int:
+    logger = logging.getLogger(__name__)
+
+    if store_dir is None and not is_catalog_store(catalog_kg_file):
+        # the compiled store is about as large as the catalog, so it's only
+        # written where asked to
+        logger.error(f"No --store-dir to compile the catalog {catalog_kg_file} to")
+        return os.EX_USAGE
+    catalog_kg, store_dir, checksum = open_catalog(catalog_kg_file, store_dir, nproc)
+
+    profiles = sorted(user_kg_dir.glob("*.subkg.ttl"))
+    logger.info(f"Collected {len(profiles)} user sub-KGs from {user_kg_dir}")
+
+    precomputed = None
+    if cache_dir is not None:
+        precomputed = NeighborhoodCache.precompute(
+            catalog_kg, checksum, cache_dir, reco_items_of(reco_dir, profiles)
+        )
+
+    metrics_out_dir.mkdir(parents=True, exist_ok=True)
+    if debug_kg_dir is not None:
+        debug_kg_dir.mkdir(parents=True, exist_ok=True)
+
+    logger.info(f"Initializing pool with {nproc} workers")
+    with get_context("fork").Pool(
+        nproc,
+        initializer=init_worker,
+        initargs=(
+            store_dir,
+            precomputed,
+            cache_size,
+            reco_dir,
+            metrics_out_dir,
+            debug_kg_dir,
+            metrics,
+        ),
+    ) as p:
+        ps_completed = p.imap_unordered(f, profiles)
+        print(list(ps_completed))
+
+    return os.EX_OK
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        format="%(asctime)-15s %(name)-15s %(process)-3d %(levelname)-15s %(message)s",
+        level=logging.INFO,
+    )
+
+    parser = ArgumentParser()
+    parser.add_argument(
+        "--catalog-kg",
+        type=pathlib.Path,
+        help="Path to the catalog KG, as Turtle or compiled with catalog_store.py",
+    )
+    parser.add_argument(
+        "--store-dir",
+        type=pathlib.Path,
+        default=None,
+        help="Where to compile a Turtle catalog to; required unless --catalog-kg "
+        "is a compiled store, as in update_user_subgraphs.py",
+    )
+    parser.add_argument(
+        "--user-kg-dir",
+        type=pathlib.Path,
+        help="Directory containing profile sub-KGs",
+    )
+    parser.add_argument(
+        "--reco-dir", type=pathlib.Path, help="Directory containing the reco-files"
+    )
+    parser.add_argument(
+        "--metrics-out-dir", type=pathlib.Path, help="Path to write the metrics to"
+    )
+    parser.add_argument(
+        "--nproc",
+        type=int,
+        default=1,
+        help="Number of workers to spawn",
+    )
+    parser.add_argument(
+        "--metrics",
+        type=lambda s: s.split(","),
+        default=METRICS,
+        help="Comma-separated metric list, as in metric_eval.py",
+    )
+    parser.add_argument(
+        "--debug-kg-dir",
+        type=pathlib.Path,
+        default=None,
+        help="[OPTIONAL] Also write each updated sub-KG here, as "
+        "update_user_subgraphs.py would",
+    )
+
+    parser.add_argument(
+        "--cache-dir",
+        type=pathlib.Path,
+        default=None,
+        help="[OPTIONAL] Neighborhood cache dir, as in update_user_subgraphs.py",
+    )
+    parser.add_argument(
+        "--cache-size",
+        type=int,
+        default=DEFAULT_CACHE_SIZE,
+        help="Neighborhoods each worker keeps in an LRU cache; 0 disables it",
+    )
+
+    args = parser.parse_args()
+
+    sys.exit(
+        run(
+            args.catalog_kg,
+            args.user_kg_dir,
+            args.reco_dir,
+            args.metrics_out_dir,
+            args.nproc,
+            args.metrics,
+            args.debug_kg_dir,
+            args.cache_dir,
+            args.cache_size,
+            args.store_dir,
+        )
+    )
@@ -0,0 +1,128 @@
+import pathlib
+
+import numpy as np
+import rdflib
+
+from kgmetrics.overlay_graph import OverlayGraph
+from kgmetrics.terms import decode_term, encode_term
+
+# Updated sub-KGs of one user, as one .npz file instead of one Turtle file per track:
+#
+#   terms, term_offsets  dictionary of all terms; term i is terms[term_offsets[i]:
+#                        term_offsets[i + 1]], in the encoding of kgmetrics.terms
+#   base                 (n, 3) term IDs of the user's sub-KG
+#   deltas               (m, 3) term IDs of the neighborhoods of all tracks, back to
+#                        back; only triples that aren't in the base
+#   delta_offsets        the neighborhood of track_ids[i] is deltas[delta_offsets[i]:
+#                        delta_offsets[i + 1]]
+#   track_ids            recommended tracks, in the order they were added
+DELTA_SUFFIX = ".kgdelta.npz"
+
+
+def is_delta_file(path: pathlib.Path) -> bool:
+    return path.is_file() and path.name.endswith(DELTA_SUFFIX)
+
+
+class DeltaWriter:
+    """Collects a user's sub-KG and the neighborhood of each recommended track."""
+
+    def __init__(self, base: rdflib.Graph):
+        self._base = base
+        self._ids: dict[bytes, int] = dict()
+        self._base_triples = self._encode(base)
+        self._deltas: list[np.ndarray] = []
+        self._track_ids: list[str] = []
+
+    def _encode(self, triples) -> np.ndarray:
+        ids = [
+            self._ids.setdefault(encode_term(t), len(self._ids))
+            for triple in triples
+            for t in triple
+        ]
+        return np.array(ids, dtype=np.int32).reshape(-1, 3)
+
+    def __len__(self) -> int:
+        return len(self._track_ids)
+
+    def add(self, track_id: str, delta: rdflib.Graph):
+        self._deltas.append(self._encode(t for t in delta if t not in self._base))
+        self._track_ids.append(track_id)
+
+    def save(self, path: pathlib.Path):
+        keys = list(self._ids)
+
+        term_offsets = np.zeros(len(keys) + 1, dtype=np.int64)
+        term_offsets[1:] = np.cumsum([len(k) for k in keys])
+
+        delta_offsets = np.zeros(len(self._deltas) + 1, dtype=np.int64)
+        delta_offsets[1:] = np.cumsum([len(d) for d in self._deltas])
+
+        with open(path, "wb") as f:
+            np.savez(
+                f,
+                terms=np.frombuffer(b"".join(keys), dtype=np.uint8),
+                term_offsets=term_offsets,
+                base=self._base_triples,
+                deltas=np.concatenate(
+                    self._deltas or [np.zeros((0, 3), dtype=np.int32)]
+                ),
+                delta_offsets=delta_offsets,
+                track_ids=np.array(self._track_ids, dtype=str),
+            )
+
+
+class UserDeltas:
+    """Lazy reader of a user's delta file.
+
+    Only the offset index is read on opening; the base graph and each track's
+    neighborhood are decoded when first asked for.
+    """
+
+    def __init__(self, path: pathlib.Path):
+        self._npz = np.load(path)
+        self._term_offsets = self._npz["term_offsets"]
+        self._delta_offsets = self._npz["delta_offsets"]
+        self.track_ids: list[str] = self._npz["track_ids"].tolist()
+        self._index = {t: i for i, t in enumerate(self.track_ids)}
+        self._terms: np.ndarray | None = None
+        self._deltas: np.ndarray | None = None
+        self._base: rdflib.Graph | None = None
+
+    def __len__(self) -> int:
+        return len(self.track_ids)
+
+    def __contains__(self, track_id: str) -> bool:
+        return track_id in self._index
+
+    def _decode(self, rows: np.ndarray) -> rdflib.Graph:
+        if self._terms is None:
+            self._terms = self._npz["terms"]
+
+        def term(i):
+            key = self._terms[self._term_offsets[i] : self._term_offsets[i + 1]]
+            return decode_term(key.tobytes())
+
+        g = rdflib.Graph()
+        for s, p, o in rows:
+            g.add((term(s), term(p), term(o)))
+        return g
+
+    @property
+    def base(self) -> rdflib.Graph:
+        if self._base is None:
+            self._base = self._decode(self._npz["base"])
+        return self._base
+
+    def delta(self, track_id: str) -> rdflib.Graph:
+        """The triples a track's neighborhood adds to the base."""
+        if self._deltas is None:
+            self._deltas = self._npz["deltas"]
+
+        i = self._index[track_id]
+        return self._decode(
+            self._deltas[self._delta_offsets[i] : self._delta_offsets[i + 1]]
+        )
+
+    def graph(self, track_id: str) -> OverlayGraph:
+        """The updated sub-KG of a track, as update_user_subgraphs.py would write it."""
+        return OverlayGraph(self.base, self.delta(track_id))
@@ -2,67 +2,258 @@ import csv
 import logging
 import os
 import pathlib
+import pickle
 import sys
 from argparse import ArgumentParser
-from multiprocessing import Pool
+from collections import OrderedDict
+from multiprocessing import get_context
 
 import rdflib
 from rdflib.namespace import FOAF, DC
 
+from catalog_store import open_catalog
+from checkpoint import Manifest, atomic_write
+from kgmetrics.catalog_store import CatalogStore, is_catalog_store
+from kgmetrics.overlay_graph import OverlayGraph
+from subgraph_deltas import DELTA_SUFFIX, DeltaWriter
+
+
+# Neighborhoods each worker keeps in memory, besides the ones loaded from the cache dir
+DEFAULT_CACHE_SIZE = 4096
+
+# Metadata added for every subject of a neighborhood, so that its tracks and artists keep
+# their names
+EXTRA_METADATA = [FOAF.name, DC.title]
 
-def getNeighbors(catalog_kg: rdflib.Graph, reco_item: rdflib.URIRef):
-    logger = logging.getLogger(__name__)
 
+def getNeighbors(catalog_kg: rdflib.Graph | CatalogStore, reco_item: rdflib.URIRef):
     neighborsKG = rdflib.Graph()
     neighborsKG += catalog_kg.triples((reco_item, None, None))  # subjects
     neighborsKG += catalog_kg.triples((None, None, reco_item))  # objects
 
-    for s, _, _ in neighborsKG:
-        neighborsKG += catalog_kg.triples((s, FOAF.name, None))
-        neighborsKG += catalog_kg.triples((s, DC.title, None))
+    # only the subjects of the neighborhood itself, not of the added metadata
+    for s in set(neighborsKG.subjects()):
+        for predicate in EXTRA_METADATA:
+            neighborsKG += catalog_kg.triples((s, predicate, None))
 
     return neighborsKG
 
 
+def user_id(profile: pathlib.Path) -> str:
+    return profile.stem.removesuffix(".subkg")
+
+
+def track_uri(track_id: str) -> rdflib.URIRef:
+    return rdflib.URIRef(f"http://last.fm/lfm-resource#t_{track_id}")
+
+
+def read_reco_track_ids(user_reco: pathlib.Path) -> list[str]:
+    with open(user_reco) as f:
+        reader = csv.DictReader(f, fieldnames=next(f).strip().split(","))
+        return [record["track_id"] for record in reader]
+
+
+class NeighborhoodCache:
+    """Neighborhoods of recommended items, computed once per item instead of per user.
+
+    Lookups are served from `precomputed`, then from a per-worker LRU of up to
+    `maxsize` items (0 disables it); anything else is computed with getNeighbors.
+    Neighborhoods only depend on the catalog, so `precompute` can persist them
+    between runs, keyed by the catalog's checksum.
+    """
+
+    def __init__(
+        self,
+        catalog_kg: rdflib.Graph | CatalogStore,
+        maxsize: int = DEFAULT_CACHE_SIZE,
+        precomputed: dict[rdflib.URIRef, tuple] | None = None,
+    ):
+        self._catalog_kg = catalog_kg
+        self._maxsize = maxsize
+        self._precomputed = precomputed or dict()
+        self._lru: OrderedDict[rdflib.URIRef, tuple] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @classmethod
+    def attach(
+        cls,
+        store_dir: pathlib.Path,
+        precomputed: dict[rdflib.URIRef, tuple] | None = None,
+        maxsize: int = DEFAULT_CACHE_SIZE,
+    ) -> "NeighborhoodCache":
+        """A cache on a compiled catalog, for a pool worker to build by itself.
+
+        `precomputed` is loaded once by the parent; forked workers inherit it
+        copy-on-write instead of each unpickling a copy of the cache file.
+        """
+        return cls(CatalogStore(store_dir), maxsize, precomputed)
+
+    def get(self, reco_item: rdflib.URIRef) -> rdflib.Graph:
+        triples = self._precomputed.get(reco_item)
+        if triples is None and reco_item in self._lru:
+            self._lru.move_to_end(reco_item)
+            triples = self._lru[reco_item]
+
+        if triples is None:
+            self.misses += 1
+            triples = tuple(getNeighbors(self._catalog_kg, reco_item))
+            if self._maxsize > 0:
+                self._lru[reco_item] = triples
+                if len(self._lru) > self._maxsize:
+                    self._lru.popitem(last=False)
+        else:
+            self.hits += 1
+
+        neighborsKG = rdflib.Graph()
+        for triple in triples:
+            neighborsKG.add(triple)
+        return neighborsKG
+
+    def stats(self) -> str:
+        lookups = self.hits + self.misses
+        if not lookups:
+            return "no lookups"
+        return (
+            f"{self.hits} hits, {self.misses} misses "
+            f"({self.hits / lookups:.1%} hit rate, {len(self._lru)} in LRU)"
+        )
+
+    @staticmethod
+    def precompute(
+        catalog_kg: rdflib.Graph | CatalogStore,
+        checksum: str,
+        cache_dir: pathlib.Path,
+        reco_items: list[rdflib.URIRef],
+    ) -> dict[rdflib.URIRef, tuple]:
+        """Persists the neighborhoods of all reco_items in cache_dir.
+
+        Neighborhoods persisted for the catalog with the same checksum are reused;
+        missing ones are computed and the file is rewritten. Files of other catalogs
+        are stale and removed. Returns the neighborhoods, for the workers to inherit.
+        """
+        logger = logging.getLogger(__name__)
+
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        cache_file = cache_dir / f"neighborhoods-{checksum}.pkl"
+
+        for stale in cache_dir.glob("neighborhoods-*.pkl"):
+            if stale != cache_file:
+                logger.info(f"Removing stale neighborhood cache {stale}")
+                stale.unlink()
+
+        precomputed: dict[rdflib.URIRef, tuple] = dict()
+        if cache_file.exists():
+            with open(cache_file, "rb") as f:
+                precomputed = pickle.load(f)
+            logger.info(f"Loaded {len(precomputed)} neighborhoods from {cache_file}")
+
+        missing = [i for i in reco_items if i not in precomputed]
+        if missing:
+            logger.info(f"Computing {len(missing)} missing neighborhoods")
+            for reco_item in missing:
+                precomputed[reco_item] = tuple(getNeighbors(catalog_kg, reco_item))
+
+            with atomic_write(cache_file) as tmp_file:
+                with open(tmp_file, "wb") as f:
+                    pickle.dump(precomputed, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+        return precomputed
+
+
+def reco_items_of(
+    reco_dir: pathlib.Path, profiles: list[pathlib.Path]
+) -> list[rdflib.URIRef]:
+    reco_files = [reco_dir / f"{user_id(p)}.csv" for p in profiles]
+    return sorted(
+        {
+            track_uri(track_id)
+            for reco_file in reco_files
+            if reco_file.exists()
+            for track_id in read_reco_track_ids(reco_file)
+        }
+    )
+
+
+def init_worker(
+    store_dir: pathlib.Path,
+    rdir: pathlib.Path,
+    odir: pathlib.Path,
+    precomputed: dict[rdflib.URIRef, tuple] | None,
+    cache_size: int,
+    ofmt: str,
+    mfst: Manifest,
+):
+    # Workers attach to the compiled catalog instead of receiving a copy of it, and
+    # inherit the precomputed neighborhoods from the parent when forked
+    global reco_dir
+    global out_dir
+    global neighborhoods
+    global output_format
+    global manifest
+    reco_dir = rdir
+    out_dir = odir
+    neighborhoods = NeighborhoodCache.attach(store_dir, precomputed, cache_size)
+    output_format = ofmt
+    manifest = mfst
+
+
 def f(profile: pathlib.Path):
     logger = logging.getLogger(__name__)
 
-    user = profile.stem.removesuffix(".subkg")
-    # reco_dir is global; assigned to each worker through process initializier
+    user = user_id(profile)
+    # reco_dir, out_dir, neighborhoods, output_format and manifest are global;
+    # assigned to each worker through init_worker
     user_reco = reco_dir / (user + ".csv")
 
     if not user_reco.exists():
         logger.error(f"No recos for {user}")
         return
 
+    # tracks finished by a previous run; empty unless resuming
+    done_tracks = manifest.done_tracks(user)
+    track_ids = [t for t in read_reco_track_ids(user_reco) if t not in done_tracks]
+    if manifest.is_done(user) or (done_tracks and not track_ids):
+        logger.info(f"Skipping {user}, done in a previous run")
+        return profile
+
     logger.info(f"Reading profile {profile.name}")
     user_kg = rdflib.Graph()
     user_kg.parse(profile)
 
     logger.info(f"Reading recos for {user}")
 
-    with open(user_reco) as f:
-        reader = csv.DictReader(f, fieldnames=next(f).strip().split(","))
-        user_out_dir = out_dir / str(user)
-        pathlib.Path(user_out_dir).mkdir(exist_ok=True)
-
-        for record in reader:
-            reco_item = rdflib.URIRef(
-                f"http://last.fm/lfm-resource#t_{record['track_id']}"
-            )
-            neigh_kg = getNeighbors(catalog_kg, reco_item)
-
-            merged_kg = user_kg + neigh_kg
-            logger.info(
-                f"merged KG contains additional {len(merged_kg)-len(user_kg)} nodes"
-            )
-
-            outfile = user_out_dir / str(f"{record['track_id']}.ttl")
-            logger.info(f"writing merged KG to {outfile}")
-            merged_kg.serialize(
-                format="ttl",
-                destination=outfile,
-            )
+    if "delta" == output_format:
+        deltas = DeltaWriter(user_kg)
+        for track_id in track_ids:
+            deltas.add(track_id, neighborhoods.get(track_uri(track_id)))
+
+        outfile = out_dir / (user + DELTA_SUFFIX)
+        logger.info(f"writing {len(deltas)} merged KGs to {outfile}")
+        with atomic_write(outfile) as tmp_file:
+            deltas.save(tmp_file)
+        manifest.record(user, outfile)
+        logger.info(f"Neighborhood cache: {neighborhoods.stats()}")
+        return profile
+
+    user_out_dir = out_dir / str(user)
+    pathlib.Path(user_out_dir).mkdir(exist_ok=True)
+
+    for track_id in track_ids:
+        neigh_kg = neighborhoods.get(track_uri(track_id))
+
+        merged_kg = OverlayGraph(user_kg, neigh_kg)
+        logger.info(
+            f"merged KG contains additional {len(merged_kg)-len(user_kg)} nodes"
+        )
+
+        outfile = user_out_dir / str(f"{track_id}.ttl")
+        logger.info(f"writing merged KG to {outfile}")
+        with atomic_write(outfile) as tmp_file:
+            merged_kg.serialize(destination=tmp_file)
+        manifest.record(user, outfile, [track_id])
+
+    logger.info(f"Neighborhood cache: {neighborhoods.stats()}")
     return profile
 
 
@@ -73,12 +264,22 @@ def run(
     out_dir: pathlib.Path,
     num_profiles: int = -1,
     nproc: int = 1,
+    fmt: str = "ttl",
+    cache_dir: pathlib.Path | None = None,
+    cache_size: int = DEFAULT_CACHE_SIZE,
+    store_dir: pathlib.Path | None = None,
+    resume: bool = False,
 ) -> int:
     logger = logging.getLogger(__name__)
 
-    logger.info(f"Reading catalog KG from {catalog_kg_file}")
-    catalog_kg = rdflib.Graph()
-    catalog_kg.parse(catalog_kg_file)
+    if store_dir is None and not is_catalog_store(catalog_kg_file):
+        # the compiled store is about as large as the catalog, so it's only
+        # written where asked to
+        logger.error(f"No --store-dir to compile the catalog {catalog_kg_file} to")
+        return os.EX_USAGE
+    catalog_kg, store_dir, checksum = open_catalog(catalog_kg_file, store_dir, nproc)
+
+    manifest = Manifest(out_dir, resume)
 
     logger.info("Collecting profiles to read")
 
@@ -91,17 +292,25 @@ def run(
 
     logger.info(f"Reading {num_profiles} from {user_kg_dir}")
 
-    def init_worker(rdir, catalog, odir):
-        global reco_dir
-        global catalog_kg
-        global out_dir
-        reco_dir = dir
-        catalog_kg = catalog
-        out_dir = odir
+    precomputed = None
+    if cache_dir is not None:
+        precomputed = NeighborhoodCache.precompute(
+            catalog_kg, checksum, cache_dir, reco_items_of(reco_dir, profiles_to_read)
+        )
 
     logger.info(f"Initializing pool with {nproc} workers")
-    with Pool(
-        nproc, initializer=init_worker, initargs=(reco_dir, catalog_kg, out_dir)
+    with get_context("fork").Pool(
+        nproc,
+        initializer=init_worker,
+        initargs=(
+            store_dir,
+            reco_dir,
+            out_dir,
+            precomputed,
+            cache_size,
+            fmt,
+            manifest,
+        ),
     ) as p:
         ps_completed = p.imap_unordered(f, profiles_to_read)
         print(list(ps_completed))
@@ -117,7 +326,16 @@ if __name__ == "__main__":
 
     parser = ArgumentParser()
     parser.add_argument(
-        "--catalog-kg", type=pathlib.Path, help="Path to the catalog KG"
+        "--catalog-kg",
+        type=pathlib.Path,
+        help="Path to the catalog KG, as Turtle or compiled with catalog_store.py",
+    )
+    parser.add_argument(
+        "--store-dir",
+        type=pathlib.Path,
+        default=None,
+        help="Where to compile a Turtle catalog to, for the workers to share; "
+        "required unless --catalog-kg is a compiled store",
     )
     parser.add_argument(
         "--user-kg-dir",
@@ -140,6 +358,35 @@ if __name__ == "__main__":
         type=int,
         help="Number of workers to spawn",
     )
+    parser.add_argument(
+        "--format",
+        choices=["ttl", "delta"],
+        default="ttl",
+        help="ttl (default) writes one Turtle file per user and track; delta writes "
+        f"one <user>{DELTA_SUFFIX} file per user, with the user's sub-KG once and "
+        "each track's neighborhood as integer-encoded triples",
+    )
+
+    parser.add_argument(
+        "--cache-dir",
+        type=pathlib.Path,
+        default=None,
+        help="[OPTIONAL] Precompute the neighborhoods of all recommended tracks and "
+        "keep them here between runs; recomputed when the catalog changes",
+    )
+    parser.add_argument(
+        "--cache-size",
+        type=int,
+        default=DEFAULT_CACHE_SIZE,
+        help="Neighborhoods each worker keeps in an LRU cache; 0 disables it",
+    )
+
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Skip the users and tracks that a previous run into the same --out-dir "
+        "finished, as recorded in its manifest",
+    )
 
     args = parser.parse_args()
 
@@ -151,5 +398,10 @@ if __name__ == "__main__":
             args.out_dir,
             args.num_profiles,
             args.nproc,
+            args.format,
+            args.cache_dir,
+            args.cache_size,
+            args.store_dir,
+            args.resume,
         )
     )
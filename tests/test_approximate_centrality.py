@@ -0,0 +1,49 @@
+import networkx as nx
+import numpy as np
+import pytest
+
+from kgmetrics.approximate_centrality import sample_pivot_scores
+from kgmetrics.concentration import CONCENTRATION_INDICES
+from kgmetrics.metrics import compute_nx_metrics
+
+
+@pytest.fixture
+def nx_kg() -> nx.DiGraph:
+    return nx.gnp_random_graph(40, 0.08, seed=1, directed=True)
+
+
+def test_all_pivots_give_exact_betweenness(nx_kg):
+    n = nx_kg.number_of_nodes()
+    scores, batch_scores = sample_pivot_scores(nx_kg, "betweenness", k=n, seed=0)
+
+    exact = nx.betweenness_centrality(nx_kg, normalized=False)
+    np.testing.assert_allclose(scores, list(exact.values()))
+    np.testing.assert_allclose(sum(batch_scores), scores)
+
+
+def test_all_pivots_give_exact_closeness(nx_kg):
+    n = nx_kg.number_of_nodes()
+    scores, _ = sample_pivot_scores(nx_kg, "closeness", k=n + 5, seed=0)
+
+    exact = nx.closeness_centrality(nx_kg)
+    np.testing.assert_allclose(scores, list(exact.values()))
+
+
+@pytest.mark.parametrize("centrality", ["betweenness", "closeness"])
+def test_approximate_metrics_with_all_pivots_equal_exact(nx_kg, centrality):
+    n = nx_kg.number_of_nodes()
+    exact = [f"{centrality}:{index}" for index in CONCENTRATION_INDICES]
+    approximate = [
+        f"{centrality}~k={k}~seed=3:{index}"
+        for k in [n, 2 * n]
+        for index in CONCENTRATION_INDICES
+    ]
+
+    errors: dict[str, float] = dict()
+    values = compute_nx_metrics(nx_kg, exact + approximate, errors)
+
+    for metric in approximate:
+        index = metric.split(":")[1]
+        assert values[metric] == pytest.approx(values[f"{centrality}:{index}"])
+    # exact values have no sampling error
+    assert not errors
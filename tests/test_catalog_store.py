@@ -0,0 +1,72 @@
+import rdflib
+from rdflib import BNode, Literal, URIRef
+from rdflib.namespace import FOAF, RDF, XSD
+
+from kgmetrics.catalog_store import (
+    CatalogStore,
+    compile_catalog,
+    encode_triples,
+    is_catalog_store,
+)
+from kgmetrics.terms import decode_term, encode_term
+
+EX = rdflib.Namespace("http://example.org/")
+
+
+def sample_kg() -> rdflib.Graph:
+    kg = rdflib.Graph()
+    kg.add((EX.track1, RDF.type, EX.Track))
+    kg.add((EX.track1, FOAF.maker, EX.artist1))
+    kg.add((EX.track1, EX.title, Literal("Über\tall\n")))
+    kg.add((EX.track1, EX.title, Literal("Tout", lang="fr")))
+    kg.add((EX.track1, EX.tempo, Literal("120.5", datatype=XSD.double)))
+    kg.add((EX.track2, FOAF.maker, EX.artist1))
+    kg.add((EX.track2, EX.genre, BNode("genre1")))
+    kg.add((EX.artist1, EX.name, Literal("")))
+    return kg
+
+
+def test_terms_round_trip():
+    for triple in sample_kg():
+        for term in triple:
+            decoded = decode_term(encode_term(term))
+            assert decoded == term
+            assert type(decoded) is type(term)
+
+
+def test_compiled_store_round_trip(tmp_path):
+    kg = sample_kg()
+    compile_catalog(kg, tmp_path / "catalog.kgstore")
+
+    assert is_catalog_store(tmp_path / "catalog.kgstore")
+    store = CatalogStore(tmp_path / "catalog.kgstore")
+
+    assert len(store) == len(kg)
+    assert set(store) == set(kg)
+
+
+def test_in_memory_store_round_trip():
+    kg = sample_kg()
+    # duplicate triples are stored once
+    keys, spo = encode_triples(kg + kg)
+    store = CatalogStore.from_triples(keys, spo)
+
+    assert len(store) == len(kg)
+    assert set(store) == set(kg)
+
+
+def test_store_patterns_match_graph():
+    kg = sample_kg()
+    store = CatalogStore.from_triples(*encode_triples(kg))
+
+    terms = {t for triple in kg for t in triple}
+    for term in terms:
+        for pattern in [(term, None, None), (None, term, None), (None, None, term)]:
+            assert set(store.triples(pattern)) == set(kg.triples(pattern))
+
+    assert set(store.objects(EX.track1, EX.title)) == set(
+        kg.objects(EX.track1, EX.title)
+    )
+    assert (EX.track2, FOAF.maker, EX.artist1) in store
+    assert (EX.track2, FOAF.maker, EX.track1) not in store
+    assert not list(store.triples((URIRef("http://example.org/unknown"), None, None)))
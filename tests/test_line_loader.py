@@ -0,0 +1,56 @@
+import numpy as np
+import rdflib
+
+from kgmetrics import line_loader
+from kgmetrics.line_loader import parse_triples
+from kgmetrics.terms import decode_term
+
+HEADER = """@prefix ex: <http://example.org/> .
+@prefix foaf: <http://xmlns.com/foaf/0.1/> .
+@prefix xsd: <http://www.w3.org/2001/XMLSchema#> .
+
+# one triple per line
+"""
+
+
+def write_kg(path, num_tracks: int, extra: str = ""):
+    lines = [HEADER]
+    for i in range(num_tracks):
+        lines.append(f"ex:track{i}\ta\tex:Track\t.\n")
+        lines.append(
+            f"ex:track{i}\tfoaf:maker\t<http://example.org/artist{i % 7}>\t.\n"
+        )
+        lines.append(f'ex:track{i}\tex:title\t"Track \\"{i}\\"\\n"@en\t.\n')
+        lines.append(f'ex:track{i}\t\tex:tempo\t"{i}.5"^^xsd:double\t.\n')
+    lines.append(extra)
+    path.write_text("".join(lines), encoding="utf-8")
+
+
+def decoded(parsed) -> set[tuple]:
+    keys, spo = parsed
+    return {tuple(decode_term(keys[i]) for i in row) for row in spo}
+
+
+def test_parallel_parse_equals_serial(tmp_path, monkeypatch):
+    path = tmp_path / "catalog.ttl"
+    write_kg(path, 200)
+
+    serial = parse_triples(path, nproc=1)
+    # split even a small file into one chunk per process
+    monkeypatch.setattr(line_loader, "MIN_CHUNK_BYTES", 1)
+    assert len(line_loader.split_chunks(path, 3)) == 3
+    parallel = parse_triples(path, nproc=3)
+
+    assert serial[0] == parallel[0]
+    np.testing.assert_array_equal(serial[1], parallel[1])
+    assert decoded(serial) == set(rdflib.Graph().parse(path))
+
+
+def test_parallel_parse_falls_back_like_serial(tmp_path, monkeypatch):
+    path = tmp_path / "catalog.ttl"
+    # a predicate-object list isn't in the dialect
+    write_kg(path, 50, "ex:track0\tex:genre\tex:rock ;\n\tex:mood\tex:calm\t.\n")
+
+    assert parse_triples(path, nproc=1) is None
+    monkeypatch.setattr(line_loader, "MIN_CHUNK_BYTES", 1)
+    assert parse_triples(path, nproc=3) is None
@@ -0,0 +1,59 @@
+import rdflib
+from rdflib import Literal
+from rdflib.namespace import FOAF, RDF
+
+from subgraph_deltas import DELTA_SUFFIX, DeltaWriter, UserDeltas, is_delta_file
+
+EX = rdflib.Namespace("http://example.org/")
+
+
+def user_kg() -> rdflib.Graph:
+    kg = rdflib.Graph()
+    kg.add((EX.user1, FOAF.knows, EX.track1))
+    kg.add((EX.track1, RDF.type, EX.Track))
+    kg.add((EX.track1, FOAF.maker, EX.artist1))
+    return kg
+
+
+def neighborhoods() -> dict[str, rdflib.Graph]:
+    track2 = rdflib.Graph()
+    track2.add((EX.track2, RDF.type, EX.Track))
+    track2.add((EX.track2, FOAF.maker, EX.artist1))
+    track2.add((EX.track2, EX.title, Literal("Zwei", lang="de")))
+
+    # overlaps the user's sub-KG
+    track1 = rdflib.Graph()
+    track1.add((EX.track1, RDF.type, EX.Track))
+    track1.add((EX.track1, EX.title, Literal("One")))
+
+    return {"2": track2, "1": track1, "3": rdflib.Graph()}
+
+
+def test_deltas_round_trip(tmp_path):
+    base = user_kg()
+    writer = DeltaWriter(base)
+    for track_id, neighborhood in neighborhoods().items():
+        writer.add(track_id, neighborhood)
+    assert len(writer) == 3
+
+    path = tmp_path / f"user1{DELTA_SUFFIX}"
+    writer.save(path)
+    assert is_delta_file(path)
+
+    deltas = UserDeltas(path)
+    assert deltas.track_ids == ["2", "1", "3"]
+    assert "1" in deltas and "4" not in deltas
+    assert set(deltas.base) == set(base)
+
+    for track_id, neighborhood in neighborhoods().items():
+        assert set(deltas.delta(track_id)) == set(neighborhood) - set(base)
+        assert set(deltas.graph(track_id)) == set(base) | set(neighborhood)
+
+
+def test_empty_deltas_round_trip(tmp_path):
+    path = tmp_path / f"user1{DELTA_SUFFIX}"
+    DeltaWriter(user_kg()).save(path)
+
+    deltas = UserDeltas(path)
+    assert len(deltas) == 0
+    assert set(deltas.base) == set(user_kg())